@@ -7,14 +7,43 @@ from . import sale
 from . import user
 from . import stock
 from . import ir
+from . import product
+from . import configuration
+from . import routes
+
+__all__ = ['register', 'routes']
+
 
 def register():
     Pool.register(
+        shop.SaleShopMigration,
+        shop.SaleShopGroup,
+        shop.SaleShopGroupClosure,
+        shop.SaleShopGroupResUser,
         shop.SaleShop,
+        shop.SaleShopLogoCache,
         shop.SaleShopResUser,
+        shop.SaleShopDailySummary,
+        shop.SaleShopAvailability,
+        shop.SaleShopChange,
         user.User,
+        user.UserCompanyShop,
         sale.Sale,
+        stock.Move,
         stock.ShipmentOut,
         stock.ShipmentOutReturn,
         ir.Rule,
+        ir.Sequence,
+        ir.Cron,
+        product.ProductListPrice,
+        product.ProductCostPrice,
+        product.PriceList,
+        product.PriceListLine,
+        configuration.Configuration,
+        configuration.ConfigurationSequence,
+        configuration.ConfigurationSaleMethod,
+        configuration.ConfigurationSalePriceList,
+        configuration.AccountConfiguration,
+        configuration.AccountConfigurationDefaultPaymentTerm,
+        configuration.Company,
         module='sale_shop', type_='model')
@@ -0,0 +1,54 @@
+# This file is part sale_shop module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+
+class SaleSettingsMixin:
+    "Clear the sale settings of the shops on modification"
+    __slots__ = ()
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        super().on_modification(mode, records, field_names=field_names)
+        Shop._sale_settings_cache.clear()
+
+
+class Configuration(SaleSettingsMixin, metaclass=PoolMeta):
+    __name__ = 'sale.configuration'
+
+
+class ConfigurationSequence(SaleSettingsMixin, metaclass=PoolMeta):
+    __name__ = 'sale.configuration.sequence'
+
+
+class ConfigurationSaleMethod(SaleSettingsMixin, metaclass=PoolMeta):
+    __name__ = 'sale.configuration.sale_method'
+
+
+class ConfigurationSalePriceList(SaleSettingsMixin, metaclass=PoolMeta):
+    __name__ = 'sale.configuration.sale_price_list'
+
+
+class AccountConfiguration(SaleSettingsMixin, metaclass=PoolMeta):
+    __name__ = 'account.configuration'
+
+
+class AccountConfigurationDefaultPaymentTerm(
+        SaleSettingsMixin, metaclass=PoolMeta):
+    __name__ = 'account.configuration.default_payment_term'
+
+
+class Company(metaclass=PoolMeta):
+    __name__ = 'company.company'
+
+    @classmethod
+    def on_modification(cls, mode, companies, field_names=None):
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        super().on_modification(mode, companies, field_names=field_names)
+        if mode == 'write' and (
+                field_names is None or 'currency' in field_names):
+            Shop._sale_settings_cache.clear()
@@ -0,0 +1,202 @@
+# This file is part sale_shop module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""Opt-in instrumentation of the sale_shop operations
+
+The instrumentation is enabled by the "sale_shop_instrument" context key or
+by the "instrument" option of the "sale_shop" configuration section. It
+records per operation the calls, SQL queries, wall time and cache hits and
+logs a summary when the transaction stops.
+"""
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import partial, wraps
+from weakref import WeakKeyDictionary
+
+from trytond import backend
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['instrument', 'instrumented', 'hit', 'miss', 'QueryCounter']
+
+logger = logging.getLogger(__name__)
+_enabled = config.getboolean('sale_shop', 'instrument', default=False)
+_states = WeakKeyDictionary()
+
+
+class QueryCounter:
+    "Count the SQL queries executed on a connection by the current thread"
+    _lock = threading.Lock()
+    # A single logger filter or trace callback dispatches the queries to the
+    # counters of the thread or of the connection, so they can be nested
+    _pg_counters = defaultdict(list)
+    _pg_level = None
+    _sqlite_counters = {}
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+        self._thread = threading.get_ident()
+
+    @staticmethod
+    def _trace(counters, *args):
+        for counter in counters:
+            counter.count += 1
+
+    @classmethod
+    def _filter(cls, record):
+        for counter in cls._pg_counters.get(record.thread, ()):
+            counter.count += 1
+        # Keep the records only if they were logged before counting
+        return cls._pg_level <= logging.DEBUG
+
+    @staticmethod
+    def _pg_logger():
+        return logging.getLogger('trytond.backend.postgresql.database')
+
+    def start(self):
+        with self._lock:
+            if backend.name == 'sqlite':
+                key = id(self.connection)
+                counters = self._sqlite_counters.get(key)
+                if counters is None:
+                    counters = self._sqlite_counters[key] = []
+                    self.connection.set_trace_callback(
+                        partial(self._trace, counters))
+                counters.append(self)
+                return
+            if not self._pg_counters:
+                db_logger = self._pg_logger()
+                QueryCounter._pg_level = db_logger.getEffectiveLevel()
+                db_logger.setLevel(logging.DEBUG)
+                db_logger.addFilter(QueryCounter._filter)
+            self._pg_counters[self._thread].append(self)
+
+    def stop(self):
+        with self._lock:
+            if backend.name == 'sqlite':
+                key = id(self.connection)
+                counters = self._sqlite_counters.get(key, [])
+                if self not in counters:
+                    return
+                counters.remove(self)
+                if not counters:
+                    del self._sqlite_counters[key]
+                    self.connection.set_trace_callback(None)
+                return
+            counters = self._pg_counters.get(self._thread, [])
+            if self not in counters:
+                return
+            counters.remove(self)
+            if not counters:
+                del self._pg_counters[self._thread]
+            if not self._pg_counters:
+                db_logger = self._pg_logger()
+                db_logger.removeFilter(QueryCounter._filter)
+                db_logger.setLevel(self._pg_level)
+
+    @contextmanager
+    def __call__(self):
+        self.start()
+        try:
+            yield self
+        finally:
+            self.stop()
+
+
+class Stats(defaultdict):
+    "Statistics per operation name"
+
+    def __init__(self):
+        super().__init__(lambda: {
+                'calls': 0,
+                'queries': 0,
+                'time': 0.,
+                'hits': 0,
+                'misses': 0,
+                })
+
+    def queries(self, *names):
+        "Return the number of queries of the operations"
+        return sum(self[n]['queries'] for n in names if n in self)
+
+
+class _State:
+
+    def __init__(self, transaction):
+        self.counter = QueryCounter(transaction.connection)
+        self.stats = [Stats()]
+        self.counter.start()
+        transaction.atexit(self.stop, transaction)
+
+    def stop(self, transaction):
+        self.counter.stop()
+        _states.pop(transaction, None)
+        stats = self.stats[0]
+        if stats:
+            logger.info("sale_shop %s", json.dumps(stats, sort_keys=True))
+
+    def add(self, name, key, value):
+        for stats in self.stats:
+            stats[name][key] += value
+
+
+def _get_state(transaction=None, force=False):
+    if transaction is None:
+        transaction = Transaction()
+    state = _states.get(transaction)
+    if state is None and transaction.connection and (force or _enabled
+            or (transaction.context or {}).get('sale_shop_instrument')):
+        state = _states[transaction] = _State(transaction)
+    return state
+
+
+def instrumented(name):
+    "Decorate a function to record it as the operation name"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            state = _get_state()
+            if state is None:
+                return func(*args, **kwargs)
+            queries = state.counter.count
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                state.add(name, 'calls', 1)
+                state.add(name, 'time', time.perf_counter() - start)
+                state.add(name, 'queries', state.counter.count - queries)
+        return wrapper
+    return decorator
+
+
+def hit(name, count=1):
+    "Record cache hits for the operation name"
+    state = _get_state()
+    if state is not None:
+        state.add(name, 'hits', count)
+
+
+def miss(name, count=1):
+    "Record cache misses for the operation name"
+    state = _get_state()
+    if state is not None:
+        state.add(name, 'misses', count)
+
+
+@contextmanager
+def instrument():
+    "Yield the statistics of the operations called inside the block"
+    transaction = Transaction()
+    state = _get_state(transaction, force=True)
+    stats = Stats()
+    state.stats.append(stats)
+    try:
+        yield stats
+    finally:
+        state.stats.remove(stats)
@@ -1,7 +1,14 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+from trytond.config import config
 from trytond.pool import Pool, PoolMeta
 
+from .instrument import instrumented
+
+# "list" puts the shops of the user in the rule context
+# "join" filters the shops of the user in SQL so the rules are shared
+SHOP_RULE_MODE = config.get('sale_shop', 'rule_mode', default='list')
+
 
 class Rule(metaclass=PoolMeta):
     __name__ = 'ir.rule'
@@ -9,20 +16,57 @@ class Rule(metaclass=PoolMeta):
     @classmethod
     def __setup__(cls):
         super().__setup__()
-        cls.domain.help += '\n- "shops" from the current user'
+        cls.domain.help += (
+            '\n- "shops" from the current user (not with join rule mode)'
+            '\n- "shop_rule_join" when the shops are filtered in SQL')
+
+    @classmethod
+    def _shop_rule_join(cls):
+        return SHOP_RULE_MODE == 'join'
 
     @classmethod
     def _get_cache_key(cls, model_name):
         pool = Pool()
         User = pool.get('res.user')
         key = super()._get_cache_key(model_name)
-        return (*key, User.get_shop())
+        if cls._shop_rule_join():
+            return key
+        return (*key, *User._get_shop_context())
 
     @classmethod
+    @instrumented('ir.rule.get_context')
     def _get_context(cls, model_name):
         pool = Pool()
         User = pool.get('res.user')
         context = super()._get_context(model_name)
-        context['shop'] = User.get_shop()
-        context['shops'] = User.get_shops()
+        context['shop_rule_join'] = cls._shop_rule_join()
+        if not context['shop_rule_join']:
+            context['shop'], context['shops'] = User._get_shop_context()
         return context
+
+
+class Sequence(metaclass=PoolMeta):
+    __name__ = 'ir.sequence'
+
+    @classmethod
+    def on_modification(cls, mode, sequences, field_names=None):
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        super().on_modification(mode, sequences, field_names=field_names)
+        # Drawing numbers only saves the next number or timestamp
+        if (mode != 'create'
+                and (field_names is None
+                    or set(field_names) - {
+                        'number_next_internal', 'last_timestamp'})):
+            Shop._sale_numbers_cache.clear()
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('sale.shop.change|compact', "Compact Shop Changes"),
+                ])
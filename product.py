@@ -0,0 +1,48 @@
+# This file is part sale_shop module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+
+class ProductListPrice(metaclass=PoolMeta):
+    __name__ = 'product.list_price'
+
+    @classmethod
+    def on_modification(cls, mode, prices, field_names=None):
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        super().on_modification(mode, prices, field_names=field_names)
+        Shop._prices_cache.clear()
+
+
+class ProductCostPrice(metaclass=PoolMeta):
+    __name__ = 'product.cost_price'
+
+    @classmethod
+    def on_modification(cls, mode, prices, field_names=None):
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        super().on_modification(mode, prices, field_names=field_names)
+        Shop._prices_cache.clear()
+
+
+class PriceList(metaclass=PoolMeta):
+    __name__ = 'product.price_list'
+
+    @classmethod
+    def on_modification(cls, mode, price_lists, field_names=None):
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        super().on_modification(mode, price_lists, field_names=field_names)
+        Shop._prices_cache.clear()
+
+
+class PriceListLine(metaclass=PoolMeta):
+    __name__ = 'product.price_list.line'
+
+    @classmethod
+    def on_modification(cls, mode, lines, field_names=None):
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        super().on_modification(mode, lines, field_names=field_names)
+        Shop._prices_cache.clear()
@@ -0,0 +1,55 @@
+# This file is part sale_shop module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime as dt
+
+from trytond.config import config
+from trytond.protocols.wrappers import (
+    HTTPStatus, Response, abort, with_pool, with_transaction)
+from trytond.transaction import Transaction
+from trytond.wsgi import app
+
+_request_timeout = config.getint('request', 'timeout', default=0)
+
+
+@app.route(
+    '/<database_name>/sale_shop/<int:shop>/sales.<any(csv, jsonl):format>',
+    methods={'GET'})
+@app.auth_required
+@with_pool
+@with_transaction(
+    user='request', context=dict(_check_access=True), timeout=_request_timeout)
+def export_sales(request, pool, shop, format):
+    "Stream the sale lines of the shop between the start and end dates"
+    User = pool.get('res.user')
+    Sale = pool.get('sale.sale')
+    try:
+        start_date = dt.date.fromisoformat(request.args['start'])
+        end_date = dt.date.fromisoformat(request.args['end'])
+    except (KeyError, ValueError):
+        abort(HTTPStatus.BAD_REQUEST)
+    if shop not in User.get_shops():
+        abort(HTTPStatus.FORBIDDEN)
+    transaction = Transaction()
+    database, user = transaction.database.name, transaction.user
+    context = User(user).get_preferences(context_only=True)
+    context['_check_access'] = True
+
+    def stream():
+        # The transaction of the request is closed before the response is
+        # streamed
+        with Transaction().start(
+                database, user, readonly=True, context=context):
+            for row in Sale.export_shop_sales(
+                    shop, start_date, end_date, format=format):
+                yield row.encode('utf-8')
+
+    mimetype = {
+        'csv': 'text/csv',
+        'jsonl': 'application/jsonl',
+        }[format]
+    response = Response(stream(), mimetype=mimetype + '; charset=utf-8')
+    response.headers.add(
+        'Content-Disposition', 'attachment',
+        filename='sales-%s.%s' % (shop, format))
+    return response
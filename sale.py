@@ -1,11 +1,35 @@
 # This file is part sale_shop module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import base64
+import csv
+import datetime as dt
+import io
+import json
+import logging
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from weakref import WeakKeyDictionary
+
 from trytond import backend
-from trytond.model import fields
-from trytond.transaction import Transaction
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.model import Index, fields
+from trytond.model.exceptions import AccessError
+from trytond.transaction import Transaction, TransactionError
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Bool, Eval
+from trytond.rpc import RPC
+
+from .instrument import hit, instrumented, miss
+
+SHOP_SALES_LIMIT = 100
+EXPORT_BATCH = config.getint('sale_shop', 'export_batch', default=1000)
+BATCH_WORKERS = config.getint('sale_shop', 'batch_workers', default=4)
+logger = logging.getLogger(__name__)
 
 
 class Sale(metaclass=PoolMeta):
@@ -19,6 +43,7 @@ class Sale(metaclass=PoolMeta):
         })
     shop_address = fields.Function(fields.Many2One('party.address',
             'Shop Address'), 'on_change_with_shop_address')
+    _current_shop_cache = WeakKeyDictionary()
 
     @classmethod
     def __setup__(cls):
@@ -33,83 +58,452 @@ class Sale(metaclass=PoolMeta):
         else:
             cls.shipment_address.domain = [('id', '=', Eval('shop_address'))]
         cls.shipment_address.depends.add('shop_address')
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.shop, Index.Range()),
+                (t.state, Index.Equality(cardinality='low')),
+                (t.sale_date, Index.Range())))
+        cls.__rpc__.update({
+                'get_shop_sales': RPC(),
+                'confirm_by_shop': RPC(readonly=False, instantiate=0),
+                })
 
     @classmethod
     def __register__(cls, module_name):
+        pool = Pool()
+        Migration = pool.get('sale.shop.migration')
         table = cls.__table_handler__(module_name)
         # Migration from 3.8: remove reference constraint
-        if not table.column_exist('number'):
-            table.drop_constraint('reference_uniq')
+        Migration.apply(cls.__name__, 'reference_uniq',
+            lambda: table.drop_constraint('reference_uniq'))
         # Migration from 5.2: remove number constraint
-        table.drop_constraint('number_uniq')
+        Migration.apply(cls.__name__, 'number_uniq',
+            lambda: table.drop_constraint('number_uniq'))
 
         super(Sale, cls).__register__(module_name)
 
+    @classmethod
+    def on_modification(cls, mode, sales, field_names=None):
+        pool = Pool()
+        Change = pool.get('sale.shop.change')
+        Summary = pool.get('sale.shop.daily_summary')
+        super().on_modification(mode, sales, field_names=field_names)
+        if mode == 'create':
+            Summary.update(Summary.get_deltas(sales))
+        operation = 'delete' if mode == 'delete' else 'write'
+        Change.log(
+            (s.shop.id, cls.__name__, s.id, operation)
+            for s in sales if s.shop)
+
+    @classmethod
+    def on_write(cls, sales, values):
+        pool = Pool()
+        Change = pool.get('sale.shop.change')
+        Summary = pool.get('sale.shop.daily_summary')
+        callback = super().on_write(sales, values)
+        if values.keys() & cls._daily_summary_fields():
+            deltas = Summary.get_deltas(sales, -1)
+            ids = [s.id for s in sales]
+            callback.append(lambda: Summary.update(
+                    Summary.get_deltas(cls.browse(ids), deltas=deltas)))
+        if 'shop' in values:
+            # The sales leave their previous shop
+            changes = [
+                (s.shop.id, cls.__name__, s.id, 'delete') for s in sales
+                if s.shop and s.shop.id != values['shop']]
+            if changes:
+                callback.append(lambda: Change.log(changes))
+        return callback
+
+    @classmethod
+    def on_delete(cls, sales):
+        pool = Pool()
+        Summary = pool.get('sale.shop.daily_summary')
+        callback = super().on_delete(sales)
+        deltas = Summary.get_deltas(sales, -1)
+        if deltas:
+            callback.append(lambda: Summary.update(deltas))
+        return callback
+
+    @classmethod
+    def _daily_summary_fields(cls):
+        return {'shop', 'sale_date', 'state', 'currency',
+            'untaxed_amount_cache', 'total_amount_cache'}
+
     @classmethod
     def current_shop(cls):
-        User = Pool().get('res.user')
+        Shop = Pool().get('sale.shop')
 
-        user = User(Transaction().user)
-        return user.shop
+        shop_id = cls.current_shop_defaults().get('shop')
+        return Shop(shop_id) if shop_id is not None else None
+
+    @classmethod
+    @instrumented('sale.sale.current_shop_defaults')
+    def current_shop_defaults(cls):
+        '''
+        Return the default values of the shop of the current user
+
+        The values are the sale settings of the shop and they are looked up
+        once per transaction and context shop(s).
+        '''
+        pool = Pool()
+        User = pool.get('res.user')
+        Shop = pool.get('sale.shop')
+        transaction = Transaction()
+        context = transaction.context
+
+        cache = cls._current_shop_cache.setdefault(transaction, {})
+        key = (transaction.user, context.get('shop'),
+            tuple(context.get('shops') or []))
+        try:
+            defaults = cache[key]
+        except KeyError:
+            miss('sale.sale.current_shop_defaults')
+        else:
+            hit('sale.sale.current_shop_defaults')
+            return defaults
+        shop_id = User.get_shop()
+        settings = (Shop.get_sale_settings([shop_id]).get(shop_id)
+            if shop_id is not None else None)
+        defaults = settings._asdict() if settings else {}
+        cache[key] = defaults
+        return defaults
+
+    @classmethod
+    def _current_shop_default(cls, name, **pattern):
+        '''
+        Return the value of the current shop for the field name
+
+        None is returned when the value does not come from the shop itself
+        or when the pattern is for another company.
+        '''
+        defaults = cls.current_shop_defaults()
+        if (name in defaults.get('shop_fields', ())
+                and pattern.get('company') in {None, defaults['company']}):
+            return defaults[name]
+
+    @classmethod
+    def clear_current_shop_cache(cls):
+        cls._current_shop_cache.pop(Transaction(), None)
+
+    @classmethod
+    @instrumented('sale.sale.apply_shop_defaults')
+    def apply_shop_defaults(cls, vlist):
+        '''
+        Return a copy of vlist filled with the sale settings of their shop
+
+        Values already set are kept and every other field is resolved from
+        the settings of the shop, so nothing falls back to the defaults of
+        the user shop. The sale price list of the party takes precedence
+        over the one of the shop like on_change_shop does.
+        '''
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Party = pool.get('party.party')
+
+        vlist = [v.copy() for v in vlist]
+        shop_settings = Shop.get_sale_settings(
+            {v['shop'] for v in vlist if v.get('shop') is not None})
+
+        company2parties = defaultdict(set)
+        for values in vlist:
+            settings = shop_settings.get(values.get('shop'))
+            if not settings:
+                continue
+            for fname in ['company', 'warehouse', 'currency', 'payment_term',
+                    'invoice_method', 'shipment_method']:
+                if fname not in values:
+                    values[fname] = getattr(settings, fname)
+            if 'price_list' not in values and values.get('party') is not None:
+                company2parties[values.get('company')].add(values['party'])
+
+        party_price_lists = {}
+        for company, party_ids in company2parties.items():
+            with Transaction().set_context(company=company):
+                for party in Party.browse(list(party_ids)):
+                    if party.sale_price_list:
+                        party_price_lists[company, party.id] = (
+                            party.sale_price_list.id)
+
+        for values in vlist:
+            settings = shop_settings.get(values.get('shop'))
+            if not settings or 'price_list' in values:
+                continue
+            values['price_list'] = party_price_lists.get(
+                (values.get('company'), values.get('party')),
+                settings.price_list)
+        return vlist
+
+    @classmethod
+    def create(cls, vlist):
+        # The defaults of the user shop must not fill the sales of other shops
+        vlist = cls.apply_shop_defaults(vlist)
+        return super().create(vlist)
 
     @classmethod
     def default_company(cls):
-        shop = cls.current_shop()
-        if shop:
-            return shop.company.id
+        company = cls.current_shop_defaults().get('company')
+        if company:
+            return company
         return super().default_company()
 
     @classmethod
     def default_shop(cls):
-        shop = cls.current_shop()
-        return shop.id if shop else None
+        return cls.current_shop_defaults().get('shop')
 
     @classmethod
     def default_invoice_method(cls, **pattern):
-        shop = cls.current_shop()
-        if shop and shop.sale_invoice_method:
-            return shop.sale_invoice_method
+        invoice_method = cls._current_shop_default(
+            'invoice_method', **pattern)
+        if invoice_method:
+            return invoice_method
         return super().default_invoice_method(**pattern)
 
     @classmethod
     def default_shipment_method(cls, **pattern):
-        shop = cls.current_shop()
-        if shop and shop.sale_shipment_method:
-            return shop.sale_shipment_method
+        shipment_method = cls._current_shop_default(
+            'shipment_method', **pattern)
+        if shipment_method:
+            return shipment_method
         return super().default_shipment_method(**pattern)
 
     @classmethod
     def default_warehouse(cls):
-        shop = cls.current_shop()
-        warehouse = None
-        if shop and shop.warehouse:
-            warehouse = shop.warehouse.id
+        warehouse = cls.current_shop_defaults().get('warehouse')
         if not warehouse:
             warehouse = super().default_warehouse()
         return warehouse
 
     @classmethod
     def default_price_list(cls):
-        shop = cls.current_shop()
-        if not shop or not shop.price_list:
-            return
-        return shop.price_list.id
+        return cls.current_shop_defaults().get('price_list')
 
     @classmethod
     def default_payment_term(cls, **pattern):
-        shop = cls.current_shop()
-        if shop and shop.payment_term:
-            return shop.payment_term.id
+        payment_term = cls._current_shop_default('payment_term', **pattern)
+        if payment_term:
+            return payment_term
         return super().default_payment_term(**pattern)
 
     @classmethod
     def default_shop_address(cls):
-        shop = cls.current_shop()
-        if not shop or not shop.address:
+        return cls.current_shop_defaults().get('shop_address')
+
+    @classmethod
+    def _shop_settings_states(cls):
+        "Return the states of the sales updated by the shop settings"
+        return ['draft', 'quotation']
+
+    @classmethod
+    def apply_shop_settings(cls, sales):
+        '''
+        Apply the settings of their shop to the open sales and re-price their
+        lines
+
+        The lines sharing the same price context and quantity are priced
+        together.
+        '''
+        pool = Pool()
+        Line = pool.get('sale.line')
+        Product = pool.get('product.product')
+
+        sales = [s for s in sales
+            if s.shop and s.state in cls._shop_settings_states()]
+        if not sales:
             return
-        return shop.address.id
+        cls.lock(sales)
+        # The shop domain is evaluated against the shops of the context
+        with Transaction().set_context(
+                shops=list({s.shop.id for s in sales})):
+            sales = cls.browse(sales)
+            lines = []
+            key2lines = defaultdict(lambda: defaultdict(list))
+            for sale in sales:
+                sale.on_change_shop()
+                for line in sale.lines:
+                    if line.type == 'line' and line.product:
+                        line.sale = sale
+                        key2lines[cls._shop_price_key(line)][
+                            line.product].append(line)
+                        lines.append(line)
+            for (context, quantity), product2lines in key2lines.items():
+                with Transaction().set_context(
+                        {k: list(v) if isinstance(v, tuple) else v
+                            for k, v in context}):
+                    prices = Product.get_sale_price(
+                        list(product2lines), quantity)
+                for product, p_lines in product2lines.items():
+                    for line in p_lines:
+                        line.unit_price = prices[product.id]
+            cls.save(sales)
+            Line.save(lines)
+
+    @classmethod
+    def _shop_price_key(cls, line):
+        "Return the key of the lines priced together by apply_shop_settings"
+        context = line._get_context_sale_price()
+        return (
+            tuple(sorted(
+                    (k, tuple(v) if isinstance(v, list) else v)
+                    for k, v in context.items())),
+            abs(line.quantity or 0))
+
+    @classmethod
+    @instrumented('sale.sale.get_shop_sales')
+    def get_shop_sales(cls, shop_id, domain=None, cursor=None, limit=None):
+        '''
+        Return a page of the sales of the shop and the cursor of the next page
+
+        The sales are ordered from the most recent and each row is a list of
+        id, number, party name, state, total amount and sale date.
+        The cursor is None when there are no more sales.
+        '''
+        limit = min(limit or SHOP_SALES_LIMIT, SHOP_SALES_LIMIT)
+        domain = [
+            ('shop', '=', shop_id),
+            domain or [],
+            ]
+        if cursor:
+            sale_date, sale_id = cls._decode_shop_sales_cursor(cursor)
+            if sale_date is None:
+                domain.append(['OR',
+                        [('sale_date', '=', None), ('id', '<', sale_id)],
+                        ('sale_date', '!=', None),
+                        ])
+            else:
+                domain.append(['OR',
+                        ('sale_date', '<', sale_date),
+                        [('sale_date', '=', sale_date), ('id', '<', sale_id)],
+                        ])
+        rows = cls.search_read(domain, limit=limit + 1,
+            order=[('sale_date', 'DESC NULLS FIRST'), ('id', 'DESC')],
+            fields_names=[
+                'number', 'party.rec_name', 'state', 'total_amount',
+                'sale_date'])
+        rows, more = rows[:limit], len(rows) > limit
+        sales = [[
+                r['id'], r['number'], (r['party.'] or {}).get('rec_name'),
+                r['state'], r['total_amount'], r['sale_date']]
+            for r in rows]
+        cursor = None
+        if more:
+            *_, last = sales
+            cursor = cls._encode_shop_sales_cursor(last[-1], last[0])
+        return sales, cursor
+
+    @classmethod
+    def export_shop_sales(cls, shop_id, start_date, end_date, format='csv'):
+        '''
+        Yield the sale lines of the shop between the dates as CSV or JSONL
+
+        The rows are read through a server-side cursor by batches of
+        export_batch so the memory does not grow with the number of lines.
+        It is served by the /<database>/sale_shop/<shop>/sales.<format> route
+        with the start and end dates as parameters.
+        '''
+        pool = Pool()
+        Line = pool.get('sale.line')
+        Party = pool.get('party.party')
+        Product = pool.get('product.product')
+        Currency = pool.get('currency.currency')
+        ModelAccess = pool.get('ir.model.access')
+        Rule = pool.get('ir.rule')
+        assert format in {'csv', 'jsonl'}
+
+        ModelAccess.check(cls.__name__, 'read')
+        ModelAccess.check(Line.__name__, 'read')
+        sale = cls.__table__()
+        line = Line.__table__()
+        party = Party.__table__()
+        product = Product.__table__()
+        currency = Currency.__table__()
+
+        where = ((sale.shop == shop_id)
+            & (sale.sale_date >= start_date)
+            & (sale.sale_date <= end_date)
+            & (line.type == 'line'))
+        if Rule.domain_get(cls.__name__):
+            where &= sale.id.in_(Rule.query_get(cls.__name__))
+        header = [
+            'number', 'sale_date', 'party', 'state', 'currency',
+            'product', 'description', 'quantity', 'unit_price']
+        query = (sale
+            .join(line, condition=line.sale == sale.id)
+            .join(party, condition=sale.party == party.id)
+            .join(currency, condition=sale.currency == currency.id)
+            .join(product, 'LEFT', condition=line.product == product.id)
+            .select(
+                sale.number, sale.sale_date, party.name, sale.state,
+                currency.code, product.code, line.description,
+                line.quantity, line.unit_price,
+                where=where,
+                order_by=[sale.sale_date.asc, sale.id.asc, line.id.asc]))
+
+        if format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator='\n')
+
+            def dump(row):
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerow(row)
+                return buffer.getvalue()
+            yield dump(header)
+        else:
+            def dump(row):
+                return json.dumps(dict(zip(header, row))) + '\n'
+
+        cursor = cls._export_cursor()
+        try:
+            cursor.execute(*query)
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dump([cls._export_value(v) for v in row])
+        finally:
+            cursor.close()
+
+    @classmethod
+    def _export_cursor(cls):
+        connection = Transaction().connection
+        if backend.name == 'postgresql':
+            # The name of the server-side cursor is unique per connection
+            cursor = connection.cursor(
+                'sale_shop_export_%s' % uuid.uuid4().hex)
+            cursor.itersize = EXPORT_BATCH
+            return cursor
+        # SQLite steps the statement on each fetch
+        return connection.cursor()
+
+    @staticmethod
+    def _export_value(value):
+        if isinstance(value, (dt.date, Decimal)):
+            return str(value)
+        return value
+
+    @classmethod
+    def _encode_shop_sales_cursor(cls, sale_date, sale_id):
+        value = json.dumps(
+            [sale_date.isoformat() if sale_date else None, sale_id])
+        return base64.urlsafe_b64encode(value.encode()).decode()
+
+    @classmethod
+    def _decode_shop_sales_cursor(cls, cursor):
+        try:
+            sale_date, sale_id = json.loads(base64.urlsafe_b64decode(cursor))
+            if sale_date:
+                sale_date = dt.date.fromisoformat(sale_date)
+            return sale_date, int(sale_id)
+        except (ValueError, TypeError):
+            raise UserError(
+                gettext('sale_shop.msg_shop_sales_invalid_cursor'))
 
     @fields.depends('shop', 'party')
+    @instrumented('sale.sale.on_change_shop')
     def on_change_shop(self):
         if not self.shop:
             return
@@ -139,14 +533,110 @@ class Sale(metaclass=PoolMeta):
                 self.payment_term = self.shop.payment_term
 
     @classmethod
+    def confirm_by_shop(cls, sales, workers=None):
+        '''
+        Quote, confirm and process the sales in one transaction per shop
+
+        The shops are run in parallel by at most workers threads, limited by
+        the "batch_workers" option. The shops must be shops of the user.
+        Return a list of shop id and error message pairs, the message is None
+        for the shops that succeeded.
+        '''
+        pool = Pool()
+        User = pool.get('res.user')
+        transaction = Transaction()
+        workers = min(workers or BATCH_WORKERS, BATCH_WORKERS)
+
+        shop2ids = defaultdict(list)
+        for sale in sales:
+            if sale.shop:
+                shop2ids[sale.shop.id].append(sale.id)
+        if transaction.check_access:
+            user_shops = set(User.get_shops())
+            for shop_id in shop2ids:
+                if shop_id not in user_shops:
+                    raise AccessError(gettext(
+                            'sale_shop.msg_shop_confirm_access',
+                            shop=shop_id))
+        database = transaction.database.name
+        user, context = transaction.user, dict(transaction.context)
+        retry = config.getint('database', 'retry')
+
+        def run(shop_id, sale_ids):
+            extras, count = {}, 0
+            while True:
+                # The shop domain is evaluated against the shops of the
+                # context
+                with cls._shop_batch_transaction(
+                        database, user, dict(context, shops=[shop_id]),
+                        **extras) as shop_transaction:
+                    try:
+                        Sale = Pool().get(cls.__name__)
+                        Sale._confirm_shop_sales(Sale.browse(sale_ids))
+                        # Commit here to handle the failures of the commit
+                        shop_transaction.commit()
+                    except Exception as exception:
+                        shop_transaction.rollback()
+                        if isinstance(exception, TransactionError):
+                            # Start again with the requested locks
+                            exception.fix(extras)
+                            continue
+                        if (isinstance(
+                                    exception,
+                                    backend.DatabaseOperationalError)
+                                and count < retry):
+                            count += 1
+                            continue
+                        logger.info(
+                            "confirm sales of shop %s failed", shop_id,
+                            exc_info=True)
+                        return shop_id, getattr(
+                            exception, 'message', str(exception))
+                return shop_id, None
+
+        if workers > 1 and len(shop2ids) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(
+                        lambda i: run(*i), shop2ids.items()))
+        return [run(*i) for i in shop2ids.items()]
+
+    @classmethod
+    def _shop_batch_transaction(cls, database, user, context, **extras):
+        return Transaction(new=True).start(
+            database, user, context=context, **extras)
+
+    @classmethod
+    def _confirm_shop_sales(cls, sales):
+        cls.quote([s for s in sales if s.state == 'draft'])
+        cls.confirm([s for s in sales if s.state == 'quotation'])
+        cls.process([s for s in sales if s.state == 'confirmed'])
+
+    @classmethod
+    @instrumented('sale.sale.set_number')
     def set_number(cls, sales):
         '''
         Fill the reference field with the sale shop or sale config sequence
         '''
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Sequence = pool.get('ir.sequence')
+
+        sales = list(sales)
+        settings = Shop.get_sale_settings(
+            {s.shop.id for s in sales if s.shop and not s.number})
+        sequence2sales = defaultdict(list)
         for sale in sales:
-            if sale.number:
+            if sale.number or not sale.shop:
                 continue
-            if sale.shop and sale.shop.sale_sequence:
-                sale.number = sale.shop.sale_sequence.get()
+            shop_settings = settings.get(sale.shop.id)
+            if shop_settings and shop_settings.sale_sequence:
+                key = (shop_settings.sale_sequence,
+                    shop_settings.sale_sequence_cache)
+                sequence2sales[key].append(sale)
+        for (sequence, cache), s_sales in sequence2sales.items():
+            numbers = Shop.get_sale_numbers(
+                Sequence(sequence), len(s_sales), cache)
+            for sale, number in zip(s_sales, numbers):
+                sale.number = number
         # super() saves all sales, so we don't need to do it here
         super().set_number(sales)
@@ -1,14 +1,68 @@
 # This file is part sale_shop module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from sql import Null, Table
+import datetime as dt
+import io
+import logging
+from collections import defaultdict, deque, namedtuple
+from decimal import Decimal
+from itertools import groupby
+from threading import Lock
 
-from trytond.model import ModelView, ModelSQL, DeactivableMixin, fields
+try:
+    import PIL
+except ImportError:
+    PIL = None
+
+from sql import Cast, Column, Conflict, Excluded, Literal, Null, Select, Table
+from sql.aggregate import Count, Max, Sum
+from sql.conditionals import Coalesce, NullIf
+from sql.functions import CurrentTimestamp, Position, Substring
+from sql.operators import Concat, Or
+
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.filestore import filestore
+from trytond.model import (
+    Model, ModelView, ModelSQL, DeactivableMixin, Index, Unique, fields,
+    tree)
+from trytond.i18n import gettext
+from trytond.ir.cron import str2bigint
+from trytond.model.exceptions import AccessError, SQLConstraintError
+from trytond.modules.currency.fields import Monetary
 from trytond.pyson import If, Eval, Id
+from trytond.rpc import RPC
 from trytond.transaction import Transaction
 from trytond.pool import Pool
+from trytond.tools import grouped_slice, reduce_ids
 from trytond import backend
 
+from .instrument import hit, instrumented, miss
+
+LOGO_SIZE_MAX = config.getint('sale_shop', 'logo_size_max', default=2048)
+LOGO_THUMBNAIL_SIZE = config.getint(
+    'sale_shop', 'logo_thumbnail_size', default=64)
+LOGO_RECEIPT_WIDTH = config.getint(
+    'sale_shop', 'logo_receipt_width', default=384)
+LOGO_RECEIPT_HEIGHT = config.getint(
+    'sale_shop', 'logo_receipt_height', default=192)
+APPLY_SETTINGS_CHUNK = config.getint(
+    'sale_shop', 'apply_settings_chunk', default=100)
+MIGRATION_DRY_RUN = config.getboolean(
+    'sale_shop', 'migration_dry_run', default=False)
+CHANGES_LIMIT = 1000
+CHANGE_RETENTION_DAYS = config.getint(
+    'sale_shop', 'change_retention_days', default=30)
+logger = logging.getLogger(__name__)
+_sale_numbers = {}
+_sale_numbers_locks = defaultdict(Lock)
+_sale_numbers_lock = Lock()
+
+SaleSettings = namedtuple('SaleSettings', [
+        'shop', 'company', 'warehouse', 'currency', 'price_list',
+        'payment_term', 'invoice_method', 'shipment_method', 'shop_address',
+        'sale_sequence', 'sale_sequence_cache', 'shop_fields'])
+
 
 class SaleShop(DeactivableMixin, ModelSQL, ModelView):
     'Sale Shop'
@@ -33,6 +87,15 @@ class SaleShop(DeactivableMixin, ModelSQL, ModelView):
             ('company', 'in', [Eval('company', -1), None]),
             ('sequence_type', '=', Id('sale', 'sequence_type_sale')),
             ])
+    sale_sequence_cache = fields.Integer(
+        "Sale Sequence Cache",
+        domain=[
+            ('sale_sequence_cache', '>=', 0),
+            ],
+        help="The amount of sale numbers reserved at once by each worker.\n"
+        "Leave empty to take the numbers from the sequence when the sales "
+        "are confirmed.\n"
+        "Reserved numbers may be skipped and are not assigned in order.")
     sale_invoice_method = fields.Selection([
             (None, ''),
             ('manual', 'Manual'),
@@ -56,112 +119,185 @@ class SaleShop(DeactivableMixin, ModelSQL, ModelView):
             'company': Eval('company', -1),
         }, depends=['company']),
         'on_change_with_company_party')
-    logo = fields.Binary('Logo')
+    logo = fields.Binary('Logo', file_id='logo_id')
+    logo_id = fields.Char("Logo ID", readonly=True)
+    logo_size = fields.Integer("Logo Size", readonly=True)
+    logo_cache = fields.One2Many(
+        'sale.shop.logo.cache', 'shop', "Logo Cache", readonly=True)
+    logo_thumbnail = fields.Function(
+        fields.Binary("Logo Thumbnail"), 'get_logo_thumbnail')
     lang = fields.Many2One("ir.lang", 'Language')
     company_trade_name = fields.Char('Company Trade Name')
     phone = fields.Char('Phone')
     website = fields.Char('Website')
     email = fields.Char('E-Mail')
+    group = fields.Many2One(
+        'sale.shop.group', "Group",
+        help="The users of the group and its parents can access the shop.")
+    current_user_shop = fields.Function(fields.Boolean(
+            "Current User Shop",
+            help="The shop is assigned to the current user."),
+        'get_current_user_shop', searcher='search_current_user_shop')
+    today_amount = fields.Function(Monetary(
+            "Today's Amount", currency='currency', digits='currency',
+            help="The total amount of the sales confirmed today."),
+        'get_daily_summary')
+    draft_sales = fields.Function(fields.Integer(
+            "Draft Sales", help="The number of sales in draft."),
+        'get_daily_summary')
+    settings_sales_total = fields.Integer(
+        "Sales to Update", readonly=True,
+        help="The number of open sales to update with the shop settings.")
+    settings_sales_done = fields.Integer("Sales Updated", readonly=True)
+    settings_progress = fields.Function(fields.Float(
+            "Settings Progress", digits=(1, 4)),
+        'get_settings_progress')
+    _warehouse_addresses_cache = Cache(
+        'sale.shop.get_warehouse_addresses', context=False)
+    _prices_cache = Cache('sale.shop.get_prices', context=False)
+    _sale_settings_cache = Cache(
+        'sale.shop.get_sale_settings', context=False)
+    # Mark the sequences for which the reserved numbers are still valid
+    _sale_numbers_cache = Cache('sale.shop.get_sale_numbers', context=False)
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.warehouse, Index.Range())),
+                Index(t, (t.company, Index.Range())),
+                Index(t, (t.group, Index.Range())),
+                })
+        cls._buttons.update({
+                'rebuild_daily_summary': {},
+                'apply_settings': {},
+                })
+        cls.__rpc__.update({
+                'get_changes': RPC(),
+                })
 
     @classmethod
     def __register__(cls, module_name):
-        connection = Transaction().connection
         pool = Pool()
         Company = pool.get('company.company')
-        Field = pool.get('ir.model.field')
-        Model = pool.get('ir.model')
+        Migration = pool.get('sale.shop.migration')
+        cursor = Transaction().connection.cursor()
         shop_table = cls.__table__()
         company_table = Company.__table__()
         table_h = cls.__table_handler__(module_name)
-        table = cls.__table__()
-        field = Field.__table__()
-        model = Model.__table__()
-        cursor = connection.cursor()
-        update = connection.cursor()
 
+        property_fields = [
+            'sale_sequence', 'sale_invoice_method', 'sale_shipment_method']
+        pending = Migration.pending(
+            cls.__name__, ['currency', 'logo', 'not_null'] + property_fields)
+        # Probe the columns before super creates them
+        table_exist = backend.TableHandler.table_exist(cls._table)
         property_exist = backend.TableHandler.table_exist('ir_property')
-        if property_exist:
-            property_ = Table('ir_property')
-        sale_sequence_exist = table_h.column_exist('sale_sequence')
-        sale_invoice_method_exist = table_h.column_exist('sale_invoice_method')
-        sale_shipment_method_exist = table_h.column_exist(
-            'sale_shipment_method')
-
-        super(SaleShop, cls).__register__(module_name)
-        if backend.name != 'sqlite':
-            # SQLite doesn't support this query as it generates and update
-            # with an alias (AS) which is not valid on SQLite
-            query = shop_table.update(columns=[shop_table.currency],
-                values=[company_table.currency],
-                from_=[company_table],
-                where=((shop_table.company == company_table.id)
-                    & (shop_table.currency == Null)))
-            cursor.execute(*query)
+        new_columns = {f for f in property_fields + ['logo_id']
+            if not table_h.column_exist(f)}
+
+        # A dry run must not create the columns as the next update would
+        # then consider their migrations useless
+        if not (MIGRATION_DRY_RUN and table_exist and pending):
+            super(SaleShop, cls).__register__(module_name)
+
+        def fill_currency():
+            cursor.execute(*shop_table.update(
+                    [shop_table.currency],
+                    [company_table.select(
+                            company_table.currency,
+                            where=company_table.id == shop_table.company)],
+                    where=shop_table.currency == Null))
+        Migration.apply(cls.__name__, 'currency', fill_currency,
+            count=shop_table.select(
+                Count(Literal('*')), where=shop_table.currency == Null))
 
         # Migration to remove Property
-        if not sale_sequence_exist and property_exist:
-            cursor.execute(*property_
-                .join(field, condition=property_.field == field.id)
-                .join(model, condition=field.model == model.id)
-                .select(
-                    property_.res,
-                    property_.value,
-                    where=property_.res.like(cls.__name__ + ',%')
-                    & (field.name == 'sale_sequence')
-                    & (model.model == cls.__name__)))
-            for res, value in cursor:
-                id_ = int(res.split(',')[1])
-                value = int(value.split(',')[1]) if value else None
-                update.execute(*table.update(
-                        [table.sale_sequence],
-                        [value],
-                        where=table.id == id_))
-        if not sale_invoice_method_exist and property_exist:
-            cursor.execute(*property_
-                .join(field, condition=property_.field == field.id)
-                .join(model, condition=field.model == model.id)
-                .select(
-                    property_.res,
-                    property_.value,
-                    where=property_.res.like(cls.__name__ + ',%')
-                    & (field.name == 'sale_invoice_method')
-                    & (model.model == cls.__name__)))
-            for res, value in cursor:
-                id_ = int(res.split(',')[1])
-                value = value.split(',')[1] if value else None
-                update.execute(*table.update(
-                        [table.sale_invoice_method],
-                        [value],
-                        where=table.id == id_))
-        if not sale_shipment_method_exist and property_exist:
-            cursor.execute(*property_
-                .join(field, condition=property_.field == field.id)
-                .join(model, condition=field.model == model.id)
-                .select(
-                    property_.res,
-                    property_.value,
-                    where=property_.res.like(cls.__name__ + ',%')
-                    & (field.name == 'sale_shipment_method')
-                    & (model.model == cls.__name__)))
-            for res, value in cursor:
-                id_ = int(res.split(',')[1])
-                value = value.split(',')[1] if value else None
-                update.execute(*table.update(
-                        [table.sale_shipment_method],
-                        [value],
-                        where=table.id == id_))
-
-        # Migration from 5.2: do not require price_list
-        table_h.not_null_action('price_list', action='remove')
-        # Migration from 5.2: do not require payment_term
-        table_h.not_null_action('payment_term', action='remove')
-        # Migration from 5.2: do not require sale_invoice_method
-        table_h.not_null_action('sale_invoice_method', action='remove')
-        # Migration from 5.2: do not require sale_shipment_method
-        table_h.not_null_action('sale_shipment_method', action='remove')
-        # Migration from 5.2: do not require currency
-        table_h.not_null_action('currency', action='remove')
+        for field_name in property_fields:
+            if field_name not in new_columns or not property_exist:
+                Migration.apply(cls.__name__, field_name)
+                continue
+            property_ = Table('ir_property')
+            Migration.apply(cls.__name__, field_name,
+                lambda: cls._migrate_property(field_name),
+                count=property_.select(
+                    Count(Literal('*')),
+                    where=property_.res.like(cls.__name__ + ',%')))
+
+        # Migration from 7.6: store logo in the filestore
+        if 'logo_id' not in new_columns:
+            Migration.apply(cls.__name__, 'logo')
+        else:
+            Migration.apply(cls.__name__, 'logo', cls._migrate_logo,
+                count=shop_table.select(
+                    Count(Literal('*')), where=shop_table.logo != Null))
+
+        def remove_not_null():
+            # Migration from 5.2: do not require price_list, payment_term,
+            # sale_invoice_method, sale_shipment_method and currency
+            for field_name in ['price_list', 'payment_term',
+                    'sale_invoice_method', 'sale_shipment_method',
+                    'currency']:
+                table_h.not_null_action(field_name, action='remove')
+        Migration.apply(cls.__name__, 'not_null', remove_not_null)
+
+    @classmethod
+    def _migrate_property(cls, field_name):
+        "Fill the empty field column from the ir_property values"
+        pool = Pool()
+        Field = pool.get('ir.model.field')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        property_ = Table('ir_property')
+        field = Field.__table__()
+
+        def split(column):
+            # Return the part after the comma of a reference
+            return NullIf(
+                Substring(column, Position(',', column) + Literal(1)), '')
+
+        id_type = cls.id.sql_type().base
+        value = split(property_.value)
+        if isinstance(cls._fields[field_name], fields.Many2One):
+            value = Cast(value, id_type)
+        query = property_.join(field, condition=property_.field == field.id)
+        where = (property_.res.like(cls.__name__ + ',%')
+            & (field.name == field_name)
+            & (field.model == cls.__name__))
+        cursor.execute(*table.update(
+                [Column(table, field_name)],
+                [query.select(
+                        value,
+                        where=where & (property_.res == Concat(
+                                cls.__name__ + ',',
+                                Cast(table.id, cls.name.sql_type().base))),
+                        limit=1)],
+                where=table.id.in_(query.select(
+                        Cast(split(property_.res), id_type),
+                        where=where))
+                & (Column(table, field_name) == Null)))
+
+    @classmethod
+    def _migrate_logo(cls):
+        "Move the logos stored in the table to the filestore"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        prefix = cls.logo.store_prefix
+        if prefix is None:
+            prefix = transaction.database.name
+        cursor.execute(*table.select(table.id, where=table.logo != Null))
+        for shop_id, in cursor.fetchall():
+            cursor.execute(*table.select(
+                    table.logo, where=table.id == shop_id))
+            logo, = cursor.fetchone()
+            logo = bytes(logo)
+            cursor.execute(*table.update(
+                    [table.logo_id, table.logo_size, table.logo],
+                    [filestore.set(logo, prefix), len(logo), Null],
+                    where=table.id == shop_id))
 
     @staticmethod
     def default_currency():
@@ -183,12 +319,568 @@ class SaleShop(DeactivableMixin, ModelSQL, ModelView):
         config = Config(1)
         return config
 
+    @classmethod
+    def get_changes(cls, shop_id, cursor=None, limit=None):
+        '''
+        Return the changes of the shop after the cursor and the new cursor
+
+        The changes are a list of model name, record id and operation, with
+        only the last operation of each record. The changes are None when the
+        cursor is missing or too old for the change log, then the client
+        must read everything again and continue from the returned cursor.
+        The shop must be one of the user shops.
+        '''
+        pool = Pool()
+        Change = pool.get('sale.shop.change')
+        User = pool.get('res.user')
+        if (Transaction().check_access
+                and shop_id not in User.get_shops()):
+            raise AccessError(gettext(
+                    'sale_shop.msg_shop_changes_access', shop=shop_id))
+        return Change.get(shop_id, cursor, min(
+                limit or CHANGES_LIMIT, CHANGES_LIMIT))
+
+    @classmethod
+    @instrumented('sale.shop.get_sale_settings')
+    def get_sale_settings(cls, shop_ids):
+        '''
+        Return a dictionary with the SaleSettings for each shop id
+
+        The empty values of the shop fall back to the sale configuration of
+        its company and then to the global one. The shop_fields are the names
+        of the values set by the shop itself.
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+        SaleConfiguration = pool.get('sale.configuration')
+        AccountConfiguration = pool.get('account.configuration')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        settings, missing = {}, []
+        for shop_id in shop_ids:
+            shop_settings = cls._sale_settings_cache.get(shop_id)
+            if shop_settings is not None:
+                settings[shop_id] = shop_settings
+            else:
+                missing.append(shop_id)
+        hit('sale.shop.get_sale_settings', len(settings))
+        miss('sale.shop.get_sale_settings', len(missing))
+        if not missing:
+            return settings
+
+        shop_values = {}
+        for sub_ids in grouped_slice(missing):
+            cursor.execute(*table.select(
+                    table.id, table.company, table.warehouse, table.currency,
+                    table.price_list, table.payment_term,
+                    table.sale_invoice_method, table.sale_shipment_method,
+                    table.address, table.sale_sequence,
+                    table.sale_sequence_cache,
+                    where=reduce_ids(table.id, sub_ids)))
+            for (shop_id, company, warehouse, currency, price_list,
+                    payment_term, invoice_method, shipment_method,
+                    address, sequence, sequence_cache) in cursor:
+                shop_values[shop_id] = {
+                    'shop': shop_id,
+                    'company': company,
+                    'warehouse': warehouse,
+                    'currency': currency,
+                    'price_list': price_list,
+                    'payment_term': payment_term,
+                    'invoice_method': invoice_method,
+                    'shipment_method': shipment_method,
+                    'shop_address': address,
+                    'sale_sequence': sequence,
+                    # The cache applies only to the sequence of the shop
+                    'sale_sequence_cache': (
+                        sequence_cache if sequence else None),
+                    }
+
+        sale_config = SaleConfiguration(1)
+        account_config = AccountConfiguration(1)
+        company_values = {}
+
+        def get(config, name, company_id):
+            value = config.get_multivalue(name, company=company_id)
+            return value.id if isinstance(value, Model) else value
+
+        for shop_id, values in shop_values.items():
+            company_id = values['company']
+            if company_id not in company_values:
+                company_values[company_id] = {
+                    'currency': Company(company_id).currency.id,
+                    'price_list': get(
+                        sale_config, 'sale_price_list', company_id),
+                    'payment_term': get(
+                        account_config, 'default_customer_payment_term',
+                        company_id),
+                    'invoice_method': get(
+                        sale_config, 'sale_invoice_method', company_id),
+                    'shipment_method': get(
+                        sale_config, 'sale_shipment_method', company_id),
+                    'sale_sequence': get(
+                        sale_config, 'sale_sequence', company_id),
+                    }
+            values['shop_fields'] = frozenset(
+                f for f, v in values.items() if v)
+            for fname, value in company_values[company_id].items():
+                if not values.get(fname):
+                    values[fname] = value
+            settings[shop_id] = shop_settings = SaleSettings(
+                **{f: values.get(f) for f in SaleSettings._fields})
+            cls._sale_settings_cache.set(shop_id, shop_settings)
+        return settings
+
+    @classmethod
+    def get_sale_numbers(cls, sequence, n, cache=None):
+        '''
+        Return a list of n numbers from the sale sequence
+
+        If cache is set, the numbers are taken from blocks of at least cache
+        numbers reserved in their own transaction and kept by the worker.
+        The blocks are dropped when the sequence is modified and never used
+        for strict sequences.
+        '''
+        if not cache or sequence._strict:
+            return list(sequence.get_many(n))
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        transaction = Transaction()
+        key = (transaction.database.name, sequence.id)
+        with _sale_numbers_lock:
+            lock = _sale_numbers_locks[key]
+        with lock:
+            if not cls._sale_numbers_cache.get(sequence.id):
+                _sale_numbers.pop(key, None)
+                cls._sale_numbers_cache.set(sequence.id, True)
+            numbers = _sale_numbers.setdefault(key, deque())
+            if len(numbers) >= n:
+                return [numbers.popleft() for _ in range(n)]
+        # The lock is not held while reserving so the other workers can
+        # still take the numbers left
+        with transaction.new_transaction():
+            block = list(Sequence(sequence.id).get_many(max(cache, n)))
+        with lock:
+            numbers = _sale_numbers.setdefault(key, deque())
+            numbers.extend(block)
+            return [numbers.popleft() for _ in range(n)]
+
+    @classmethod
+    @instrumented('sale.shop.get_warehouse_addresses')
+    def get_warehouse_addresses(cls, warehouse_ids):
+        '''
+        Return a dictionary with the tuple of active shop address ids for
+        each warehouse id
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        addresses, missing = {}, []
+        for warehouse_id in warehouse_ids:
+            warehouse_addresses = cls._warehouse_addresses_cache.get(
+                warehouse_id)
+            if warehouse_addresses is not None:
+                addresses[warehouse_id] = warehouse_addresses
+            else:
+                missing.append(warehouse_id)
+        hit('sale.shop.get_warehouse_addresses', len(addresses))
+        miss('sale.shop.get_warehouse_addresses', len(missing))
+
+        for sub_ids in grouped_slice(missing):
+            sub_ids = list(sub_ids)
+            sub_addresses = {w: [] for w in sub_ids}
+            cursor.execute(*table.select(
+                    table.warehouse, table.address,
+                    where=reduce_ids(table.warehouse, sub_ids)
+                    & (table.address != Null)
+                    & (table.active == Literal(True)),
+                    order_by=[table.id.asc]))
+            for warehouse_id, address_id in cursor:
+                sub_addresses[warehouse_id].append(address_id)
+            for warehouse_id, warehouse_addresses in sub_addresses.items():
+                addresses[warehouse_id] = tuple(warehouse_addresses)
+                cls._warehouse_addresses_cache.set(
+                    warehouse_id, addresses[warehouse_id])
+        return addresses
+
+    @classmethod
+    def get_current_user_shop(cls, shops, name):
+        pool = Pool()
+        User = pool.get('res.user')
+        user_shops = set(User.get_shops())
+        return {s.id: s.id in user_shops for s in shops}
+
+    @classmethod
+    def search_current_user_shop(cls, name, clause):
+        transaction = Transaction()
+        table = cls.__table__()
+
+        # The rules are searched as root with the user in the context
+        user_id = transaction.user or transaction.context.get('user')
+        _, operator, value = clause
+        query = table.select(table.id,
+            where=table.id.in_(cls._user_shops_query(user_id))
+            & (table.active == Literal(True)))
+        if (operator == '=') == bool(value):
+            return [('id', 'in', query)]
+        return [('id', 'not in', query)]
+
+    @classmethod
+    def _user_shops_query(cls, user_id):
+        "Return the query of the ids of the shops the user can access"
+        pool = Pool()
+        UserShop = pool.get('sale.shop-res.user')
+        GroupUser = pool.get('sale.shop.group-res.user')
+        Closure = pool.get('sale.shop.group.closure')
+        shop = cls.__table__()
+        user_shop = UserShop.__table__()
+        group_user = GroupUser.__table__()
+        closure = Closure.__table__()
+
+        return (user_shop.select(
+                user_shop.shop.as_('shop'),
+                where=user_shop.user == user_id)
+            | group_user.join(closure,
+                condition=group_user.group == closure.ancestor
+                ).join(shop,
+                condition=closure.descendant == shop.group
+                ).select(
+                shop.id.as_('shop'),
+                where=group_user.user == user_id))
+
+    @classmethod
+    @instrumented('sale.shop.get_prices')
+    def get_prices(cls, shop, product_quantities):
+        '''
+        Return a dictionary with the unit price under the price list and
+        currency of the shop for each product id and quantity pair
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Product = pool.get('product.product')
+        transaction = Transaction()
+
+        company = shop.company
+        currency = shop.currency or company.currency
+        price_list = shop.price_list.id if shop.price_list else None
+        context = {
+            'company': company.id,
+            'currency': currency.id,
+            'price_list': price_list,
+            }
+        with transaction.set_context(context):
+            today = Date.today()
+
+        prices, missing, unknown = {}, defaultdict(list), object()
+        for product_id, quantity in set(product_quantities):
+            key = (
+                company.id, price_list, currency.id, product_id, quantity,
+                today)
+            price = cls._prices_cache.get(key, unknown)
+            if price is not unknown:
+                prices[product_id, quantity] = price
+            else:
+                missing[quantity].append(product_id)
+        hit('sale.shop.get_prices', len(prices))
+        miss('sale.shop.get_prices', sum(map(len, missing.values())))
+
+        with transaction.set_context(context, sale_date=today):
+            for quantity, product_ids in missing.items():
+                products = Product.browse(product_ids)
+                for product_id, price in Product.get_sale_price(
+                        products, quantity).items():
+                    prices[product_id, quantity] = price
+                    cls._prices_cache.set(
+                        (company.id, price_list, currency.id, product_id,
+                            quantity, today),
+                        price)
+        return prices
+
+    @classmethod
+    @instrumented('sale.shop.get_availability')
+    def get_availability(cls, shop, product_ids):
+        '''
+        Return a dictionary with the quantity available in the warehouse of
+        the shop for each product id
+        '''
+        pool = Pool()
+        Availability = pool.get('sale.shop.availability')
+        with Transaction().set_context(company=shop.company.id):
+            return Availability.get(shop.warehouse.id, product_ids)
+
+    @classmethod
+    @instrumented('sale.shop.get_daily_summary')
+    def get_daily_summary(cls, shops, names):
+        pool = Pool()
+        Summary = pool.get('sale.shop.daily_summary')
+        Date = pool.get('ir.date')
+        cursor = Transaction().connection.cursor()
+        table = Summary.__table__()
+
+        todays = {}
+        key = lambda s: s.company
+        for company, c_shops in groupby(sorted(shops, key=key), key=key):
+            with Transaction().set_context(company=company.id):
+                today = Date.today()
+            todays.update((s.id, today) for s in c_shops)
+        currencies = {s.id: s.currency or s.company.currency for s in shops}
+        confirmed_states = Summary._confirmed_states()
+
+        amounts = dict.fromkeys(map(int, shops))
+        drafts = dict.fromkeys(map(int, shops), 0)
+        for sub_ids in grouped_slice(list(map(int, shops))):
+            cursor.execute(*table.select(
+                    table.shop, table.date, table.state, table.currency,
+                    Sum(table.sales), Sum(table.total_amount),
+                    where=reduce_ids(table.shop, sub_ids)
+                    & ((table.state == 'draft')
+                        | (table.date.in_(list(set(todays.values())))
+                            & table.state.in_(confirmed_states))),
+                    group_by=[
+                        table.shop, table.date, table.state,
+                        table.currency]))
+            for shop_id, date, state, currency_id, sales, amount in cursor:
+                if state == 'draft':
+                    drafts[shop_id] += sales
+                elif (date == todays[shop_id]
+                        and currency_id == currencies[shop_id].id):
+                    # SQLite returns float for the sum of numeric
+                    amount = Decimal(str(amount))
+                    amounts[shop_id] = (amounts[shop_id] or 0) + amount
+
+        result = {}
+        if 'today_amount' in names:
+            result['today_amount'] = {
+                i: currencies[i].round(a) if a is not None else None
+                for i, a in amounts.items()}
+        if 'draft_sales' in names:
+            result['draft_sales'] = drafts
+        return result
+
+    @classmethod
+    @ModelView.button
+    def rebuild_daily_summary(cls, shops):
+        pool = Pool()
+        Summary = pool.get('sale.shop.daily_summary')
+        Summary.rebuild(shops)
+
+    def get_settings_progress(self, name):
+        if self.settings_sales_total:
+            return min(
+                (self.settings_sales_done or 0) / self.settings_sales_total,
+                1)
+
+    @classmethod
+    @ModelView.button
+    def apply_settings(cls, shops):
+        "Apply the settings of the shops to their open sales in background"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        for shop in shops:
+            sales = Sale.search([
+                    ('shop', '=', shop.id),
+                    ('state', 'in', Sale._shop_settings_states()),
+                    ], order=[('id', 'ASC')])
+            cls.write([shop], {
+                    'settings_sales_total': len(sales),
+                    'settings_sales_done': 0,
+                    })
+            for sub_sales in grouped_slice(
+                    sales, count=APPLY_SETTINGS_CHUNK):
+                cls.__queue__.apply_settings_chunk(
+                    [shop], [s.id for s in sub_sales])
+
+    @classmethod
+    def apply_settings_chunk(cls, shops, sale_ids):
+        "Apply the settings of the shop to a chunk of its sales"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        shop, = shops
+        Sale.apply_shop_settings([
+                s for s in Sale.browse(sale_ids) if s.shop == shop])
+        cursor.execute(*table.update(
+                [table.settings_sales_done],
+                [Coalesce(table.settings_sales_done, 0) + len(sale_ids)],
+                where=table.id == shop.id))
+
     @fields.depends('company')
     def on_change_with_company_party(self, name=None):
         if self.company and self.company.party:
             return self.company.party.id
         return None
 
+    @classmethod
+    def preprocess_values(cls, mode, values):
+        values = super().preprocess_values(mode, values)
+        if 'logo' in values:
+            if logo := values['logo']:
+                values['logo'] = logo = cls._logo_convert(logo)
+            values['logo_size'] = len(logo) if logo else None
+        return values
+
+    @classmethod
+    def on_modification(cls, mode, shops, field_names=None):
+        pool = Pool()
+        Change = pool.get('sale.shop.change')
+        Sale = pool.get('sale.sale')
+        User = pool.get('res.user')
+        super().on_modification(mode, shops, field_names=field_names)
+        Sale.clear_current_shop_cache()
+        cls._sale_settings_cache.clear()
+        if mode in {'create', 'write'}:
+            Change.log((s.id, cls.__name__, s.id, 'write') for s in shops)
+        if mode in {'create', 'write'} and (
+                field_names is None or 'logo' in field_names):
+            shops = cls.browse(shops)
+            if mode == 'write':
+                cls._logo_clear_cache(shops)
+            cls._logo_render_variants(shops)
+        if (mode in {'create', 'delete'} or field_names is None
+                or {'warehouse', 'address', 'active'} & set(field_names)):
+            cls._warehouse_addresses_cache.clear()
+        if (mode in {'create', 'delete'} or field_names is None
+                or {'active', 'group'} & set(field_names)):
+            User._get_shops_cache.clear()
+        if (mode in {'create', 'delete'} or field_names is None
+                or {'name', 'company', 'group', 'active'}
+                & set(field_names)):
+            User._shop_catalog_cache.clear()
+
+    @classmethod
+    def _logo_convert(cls, image, **_params):
+        if not PIL:
+            return image
+        data = io.BytesIO()
+        img = PIL.Image.open(io.BytesIO(image))
+        img.thumbnail((LOGO_SIZE_MAX, LOGO_SIZE_MAX))
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        img.save(data, format='png', optimize=True, dpi=(300, 300), **_params)
+        return data.getvalue()
+
+    @classmethod
+    def _logo_variants(cls):
+        "Return the sizes of the logo rendered when it is stored"
+        return [
+            (LOGO_THUMBNAIL_SIZE, LOGO_THUMBNAIL_SIZE),
+            (LOGO_RECEIPT_WIDTH, LOGO_RECEIPT_HEIGHT),
+            ]
+
+    def get_logo(self, width, height):
+        "Return logo image with mime-type and size in pixel"
+        if not self.logo_size:
+            raise ValueError("No logo")
+        width, height = round(width), round(height)
+        if not all(0 < s <= LOGO_SIZE_MAX for s in [width, height]):
+            raise ValueError(f"Invalid size {width} × {height}")
+        cached_sizes = set()
+        for cache in self.logo_cache:
+            cached_sizes.add((cache.width, cache.height))
+            if ((cache.width == width and cache.height <= height)
+                    or (cache.width <= width and cache.height == height)):
+                return cache.image, 'image/png', cache.width, cache.height
+
+        try:
+            with Transaction().new_transaction():
+                image, width, height = self._logo_resize(width, height)
+                if (width, height) not in cached_sizes:
+                    cache = self._logo_store_cache(image, width, height)
+                    # Save cache only if record is already committed
+                    if self.__class__.search([('id', '=', self.id)]):
+                        cache.save()
+        except SQLConstraintError:
+            logger.info("caching shop logo failed", exc_info=True)
+        return image, 'image/png', width, height
+
+    def get_receipt_logo(self):
+        "Return the logo image with mime-type and size for receipts"
+        return self.get_logo(LOGO_RECEIPT_WIDTH, LOGO_RECEIPT_HEIGHT)
+
+    @classmethod
+    def get_logo_thumbnail(cls, shops, name):
+        thumbnails = {}
+        for shop in shops:
+            thumbnails[shop.id] = None
+            if shop.logo_size:
+                thumbnails[shop.id], *_ = shop.get_logo(
+                    LOGO_THUMBNAIL_SIZE, LOGO_THUMBNAIL_SIZE)
+        return thumbnails
+
+    def _logo_resize(self, width, height, **_params):
+        if not PIL:
+            return self.logo, width, height
+        data = io.BytesIO()
+        img = PIL.Image.open(io.BytesIO(self.logo))
+        img.thumbnail((width, height))
+        img.save(data, format='png', optimize=True, dpi=(300, 300), **_params)
+        return data.getvalue(), img.width, img.height
+
+    def _logo_store_cache(self, image, width, height):
+        Cache = self.__class__.logo_cache.get_target()
+        return Cache(
+            shop=self,
+            image=image,
+            width=width,
+            height=height)
+
+    @classmethod
+    def _logo_clear_cache(cls, shops):
+        Cache = cls.logo_cache.get_target()
+        caches = [c for r in shops for c in r.logo_cache]
+        Cache.delete(caches)
+
+    @classmethod
+    def _logo_render_variants(cls, shops):
+        "Store the resized logo variants in the cache"
+        Cache = cls.logo_cache.get_target()
+        if not PIL:
+            return
+        caches = []
+        for shop in shops:
+            if not shop.logo_size:
+                continue
+            sizes = set()
+            for width, height in cls._logo_variants():
+                image, width, height = shop._logo_resize(width, height)
+                if (width, height) not in sizes:
+                    sizes.add((width, height))
+                    caches.append(shop._logo_store_cache(image, width, height))
+        Cache.save(caches)
+
+
+class SaleShopLogoCache(ModelSQL):
+    'Sale Shop Logo Cache'
+    __name__ = 'sale.shop.logo.cache'
+
+    shop = fields.Many2One(
+        'sale.shop', "Shop", required=True, ondelete='CASCADE')
+    image = fields.Binary("Image", required=True)
+    width = fields.Integer(
+        "Width", required=True,
+        domain=[
+            ('width', '>', 0),
+            ('width', '<=', LOGO_SIZE_MAX),
+            ])
+    height = fields.Integer(
+        "Height", required=True,
+        domain=[
+            ('height', '>', 0),
+            ('height', '<=', LOGO_SIZE_MAX),
+            ])
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('dimension_unique', Unique(t, t.shop, t.width, t.height),
+                'sale_shop.msg_shop_logo_cache_size_unique'),
+            ]
+
 
 class SaleShopResUser(ModelSQL):
     'Sale Shop - Res User'
@@ -198,3 +890,740 @@ class SaleShopResUser(ModelSQL):
     shop = fields.Many2One('sale.shop', 'Shop', ondelete='CASCADE', required=True)
     user = fields.Many2One('res.user', 'User', ondelete='RESTRICT',
         required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('user_shop_unique', Unique(t, t.user, t.shop),
+                'sale_shop.msg_shop_user_unique'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        first = cls.__table__()
+        duplicate = cls.__table__()
+
+        # Remove duplicates before adding the unique constraint
+        if backend.TableHandler.table_exist(cls._table):
+            cursor.execute(*table.delete(
+                    where=table.id.in_(first.join(duplicate,
+                            condition=(first.user == duplicate.user)
+                            & (first.shop == duplicate.shop)
+                            & (first.id < duplicate.id)
+                            ).select(duplicate.id))))
+
+        super().__register__(module_name)
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Change = pool.get('sale.shop.change')
+        Sale = pool.get('sale.sale')
+        User = pool.get('res.user')
+        super().on_modification(mode, records, field_names=field_names)
+        Sale.clear_current_shop_cache()
+        User._get_shops_cache.clear()
+        User._shop_catalog_cache.clear()
+        operation = 'delete' if mode == 'delete' else 'write'
+        Change.log(
+            (r.shop.id, cls.__name__, r.id, operation)
+            for r in cls.browse(records))
+
+
+class SaleShopGroup(tree(separator=' / '), ModelSQL, ModelView):
+    'Sale Shop Group'
+    __name__ = 'sale.shop.group'
+
+    name = fields.Char("Name", required=True)
+    parent = fields.Many2One(
+        'sale.shop.group', "Parent", ondelete='RESTRICT')
+    children = fields.One2Many('sale.shop.group', 'parent', "Children")
+    shops = fields.One2Many('sale.shop', 'group', "Shops")
+    users = fields.Many2Many(
+        'sale.shop.group-res.user', 'group', 'user', "Users")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('name', 'ASC'))
+
+    @classmethod
+    def on_modification(cls, mode, groups, field_names=None):
+        pool = Pool()
+        Closure = pool.get('sale.shop.group.closure')
+        Sale = pool.get('sale.sale')
+        User = pool.get('res.user')
+        super().on_modification(mode, groups, field_names=field_names)
+        if mode == 'create':
+            groups = cls.browse(groups)
+            Closure.create_self(groups)
+            # The children created with the group are created before it
+            Closure.attach(
+                [g for g in groups if g.parent]
+                + [c for g in groups for c in g.children])
+        elif mode == 'write' and (
+                field_names is None or 'parent' in field_names):
+            for group in cls.browse(groups):
+                Closure.detach([group])
+                Closure.attach([group])
+        if mode != 'write' or field_names is None or 'parent' in field_names:
+            Sale.clear_current_shop_cache()
+            User._get_shops_cache.clear()
+            User._shop_catalog_cache.clear()
+
+
+class SaleShopGroupClosure(ModelSQL):
+    'Sale Shop Group Closure'
+    __name__ = 'sale.shop.group.closure'
+
+    ancestor = fields.Many2One(
+        'sale.shop.group', "Ancestor", required=True, ondelete='CASCADE')
+    descendant = fields.Many2One(
+        'sale.shop.group', "Descendant", required=True, ondelete='CASCADE')
+    depth = fields.Integer("Depth", required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.ancestor, Index.Range()),
+                    (t.descendant, Index.Range())),
+                Index(t, (t.descendant, Index.Range())),
+                })
+
+    @classmethod
+    def create_self(cls, groups):
+        "Insert the link of each group to itself"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        for sub_groups in grouped_slice(groups):
+            cursor.execute(*table.insert([
+                        table.ancestor, table.descendant, table.depth,
+                        table.create_date, table.create_uid],
+                    [[g.id, g.id, 0, CurrentTimestamp(), transaction.user]
+                        for g in sub_groups]))
+
+    @classmethod
+    def attach(cls, groups):
+        "Link the groups and their descendants to the ancestors of the parent"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        ancestor = cls.__table__()
+        descendant = cls.__table__()
+
+        for group in groups:
+            if not group.parent:
+                continue
+            cursor.execute(*table.insert([
+                        table.ancestor, table.descendant, table.depth,
+                        table.create_date, table.create_uid],
+                    ancestor.join(descendant,
+                        condition=(ancestor.descendant == group.parent.id)
+                        & (descendant.ancestor == group.id)
+                        ).select(
+                        ancestor.ancestor, descendant.descendant,
+                        ancestor.depth + descendant.depth + 1,
+                        CurrentTimestamp(), Literal(transaction.user))))
+
+    @classmethod
+    def detach(cls, groups):
+        "Unlink the groups and their descendants from their ancestors"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        ancestor = cls.__table__()
+        descendant = cls.__table__()
+
+        for group in groups:
+            cursor.execute(*table.delete(
+                    where=table.descendant.in_(descendant.select(
+                            descendant.descendant,
+                            where=descendant.ancestor == group.id))
+                    & table.ancestor.in_(ancestor.select(
+                            ancestor.ancestor,
+                            where=(ancestor.descendant == group.id)
+                            & (ancestor.ancestor != group.id)))))
+
+
+class SaleShopGroupResUser(ModelSQL):
+    'Sale Shop Group - Res User'
+    __name__ = 'sale.shop.group-res.user'
+
+    group = fields.Many2One(
+        'sale.shop.group', "Group", required=True, ondelete='CASCADE')
+    user = fields.Many2One(
+        'res.user', "User", required=True, ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('user_group_unique', Unique(t, t.user, t.group),
+                'sale_shop.msg_shop_group_user_unique'),
+            ]
+        cls._sql_indexes.add(Index(t, (t.user, Index.Range())))
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        User = pool.get('res.user')
+        super().on_modification(mode, records, field_names=field_names)
+        Sale.clear_current_shop_cache()
+        User._get_shops_cache.clear()
+        User._shop_catalog_cache.clear()
+
+
+class SaleShopDailySummary(ModelSQL, ModelView):
+    'Sale Shop Daily Summary'
+    __name__ = 'sale.shop.daily_summary'
+
+    shop = fields.Many2One(
+        'sale.shop', "Shop", required=True, readonly=True,
+        ondelete='CASCADE')
+    date = fields.Date("Date", required=True, readonly=True)
+    state = fields.Selection('get_states', "State", readonly=True)
+    currency = fields.Many2One(
+        'currency.currency', "Currency", required=True, readonly=True)
+    sales = fields.Integer("Sales", readonly=True)
+    untaxed_amount = Monetary(
+        "Untaxed Amount", currency='currency', digits='currency',
+        readonly=True)
+    total_amount = Monetary(
+        "Total Amount", currency='currency', digits='currency',
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('key_unique', Unique(t, t.shop, t.date, t.state, t.currency),
+                'sale_shop.msg_shop_daily_summary_unique'),
+            ]
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @classmethod
+    def get_states(cls):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        return Sale.fields_get(['state'])['state']['selection']
+
+    @classmethod
+    def _confirmed_states(cls):
+        return ['confirmed', 'processing', 'done']
+
+    @classmethod
+    def get_deltas(cls, sales, sign=1, deltas=None):
+        '''
+        Add to deltas the number of sales and amounts of the sales by summary
+        key and return it
+
+        The sales without date, like the drafts, are summarized at their
+        creation date.
+        '''
+        if deltas is None:
+            deltas = defaultdict(lambda: [0, 0, 0])
+        for sale in sales:
+            if not sale.shop or not sale.currency:
+                continue
+            date = sale.sale_date or sale.create_date.date()
+            delta = deltas[sale.shop.id, date, sale.state, sale.currency.id]
+            delta[0] += sign
+            delta[1] += sign * (sale.untaxed_amount_cache or 0)
+            delta[2] += sign * (sale.total_amount_cache or 0)
+        return deltas
+
+    @classmethod
+    def _key_condition(cls, table, key, date_column='date'):
+        shop, date, state, currency = key
+        return ((table.shop == shop)
+            & (Column(table, date_column) == date)
+            & (table.state == state)
+            & (table.currency == currency))
+
+    @classmethod
+    def _summary_query(cls, sale, where):
+        return sale.select(
+            sale.shop, sale.sale_date, sale.state, sale.currency,
+            Count(Literal('*')),
+            Sum(Coalesce(sale.untaxed_amount_cache, 0)),
+            Sum(Coalesce(sale.total_amount_cache, 0)),
+            CurrentTimestamp(), Literal(Transaction().user),
+            where=where & (sale.sale_date != Null),
+            group_by=[sale.shop, sale.sale_date, sale.state, sale.currency])
+
+    @classmethod
+    def _undated_deltas(cls, sale, where):
+        "Return the deltas of the sales without date"
+        cursor = Transaction().connection.cursor()
+        deltas = defaultdict(lambda: [0, 0, 0])
+        cursor.execute(*sale.select(
+                sale.shop, sale.create_date, sale.state, sale.currency,
+                Coalesce(sale.untaxed_amount_cache, 0),
+                Coalesce(sale.total_amount_cache, 0),
+                where=where & (sale.sale_date == Null)
+                & (sale.currency != Null)))
+        for (shop, create_date, state, currency, untaxed_amount,
+                total_amount) in cursor:
+            delta = deltas[shop, create_date.date(), state, currency]
+            delta[0] += 1
+            delta[1] += untaxed_amount
+            delta[2] += total_amount
+        return deltas
+
+    @classmethod
+    def _insert_columns(cls, table):
+        return [
+            table.shop, table.date, table.state, table.currency,
+            table.sales, table.untaxed_amount, table.total_amount,
+            table.create_date, table.create_uid]
+
+    @classmethod
+    def update(cls, deltas):
+        '''
+        Add the deltas of the number of sales and amounts to the summaries
+
+        The summaries are incremented instead of aggregated again from the
+        sales so concurrent transactions do not overwrite each other.
+        '''
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        # Update in the key order to avoid deadlocks
+        deltas = sorted((k, d) for k, d in deltas.items() if any(d))
+        if not deltas:
+            return
+        on_conflict = database.has_insert_on_conflict()
+        if not on_conflict:
+            cls.lock()
+        for key, (sales, untaxed_amount, total_amount) in deltas:
+            if on_conflict:
+                cursor.execute(*table.insert(
+                        cls._insert_columns(table),
+                        [[*key, sales, untaxed_amount, total_amount,
+                                CurrentTimestamp(), transaction.user]],
+                        on_conflict=Conflict(
+                            table,
+                            indexed_columns=[
+                                table.shop, table.date, table.state,
+                                table.currency],
+                            columns=[
+                                table.sales, table.untaxed_amount,
+                                table.total_amount,
+                                table.write_date, table.write_uid],
+                            values=[
+                                table.sales + Excluded.sales,
+                                table.untaxed_amount
+                                + Excluded.untaxed_amount,
+                                table.total_amount + Excluded.total_amount,
+                                CurrentTimestamp(), transaction.user])))
+                continue
+            cursor.execute(*table.update(
+                    [table.sales, table.untaxed_amount, table.total_amount,
+                        table.write_date, table.write_uid],
+                    [table.sales + sales,
+                        table.untaxed_amount + untaxed_amount,
+                        table.total_amount + total_amount,
+                        CurrentTimestamp(), transaction.user],
+                    where=cls._key_condition(table, key)))
+            if not cursor.rowcount:
+                cursor.execute(*table.insert(
+                        cls._insert_columns(table),
+                        [[*key, sales, untaxed_amount, total_amount,
+                                CurrentTimestamp(), transaction.user]]))
+        for sub_deltas in grouped_slice(deltas):
+            cursor.execute(*table.delete(
+                    where=(table.sales == 0)
+                    & Or([cls._key_condition(table, k)
+                            for k, _ in sub_deltas])))
+
+    @classmethod
+    def rebuild(cls, shops=None):
+        "Recompute all the summaries of the shops or of all shops"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        sale = Sale.__table__()
+
+        cls.lock()
+        if shops is None:
+            cursor.execute(*table.delete())
+            cursor.execute(*table.insert(
+                    cls._insert_columns(table),
+                    cls._summary_query(sale, sale.shop != Null)))
+            cls.update(cls._undated_deltas(sale, sale.shop != Null))
+            return
+        for sub_ids in grouped_slice(shops):
+            sub_ids = list(map(int, sub_ids))
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.shop, sub_ids)))
+            cursor.execute(*table.insert(
+                    cls._insert_columns(table),
+                    cls._summary_query(sale, reduce_ids(sale.shop, sub_ids))))
+            cls.update(
+                cls._undated_deltas(sale, reduce_ids(sale.shop, sub_ids)))
+
+
+class SaleShopAvailability(ModelSQL):
+    'Sale Shop Availability'
+    __name__ = 'sale.shop.availability'
+
+    warehouse = fields.Many2One(
+        'stock.location', "Warehouse", required=True, ondelete='CASCADE')
+    product = fields.Many2One(
+        'product.product', "Product", required=True, ondelete='CASCADE')
+    date = fields.Date("Date", required=True)
+    quantity = fields.Float("Quantity", required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('key_unique', Unique(t, t.warehouse, t.product),
+                'sale_shop.msg_shop_availability_unique'),
+            ]
+
+    @classmethod
+    def get(cls, warehouse_id, product_ids):
+        '''
+        Return the available quantity of the products in the warehouse
+
+        The quantities not stored for today are computed and stored unless
+        the transaction is readonly.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        today = Date.today()
+        quantities, missing = {}, []
+        for sub_ids in grouped_slice(set(product_ids)):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.select(
+                    table.product, table.quantity,
+                    where=(table.warehouse == warehouse_id)
+                    & reduce_ids(table.product, sub_ids)
+                    & (table.date == today)))
+            quantities.update(cursor)
+            missing.extend(p for p in sub_ids if p not in quantities)
+        hit('sale.shop.get_availability', len(quantities))
+        miss('sale.shop.get_availability', len(missing))
+        if missing:
+            computed = cls._compute(warehouse_id, missing, today)
+            if not transaction.readonly:
+                cls._store(warehouse_id, computed, today)
+            quantities.update(computed)
+        return quantities
+
+    @classmethod
+    def _compute(cls, warehouse_id, product_ids, date):
+        pool = Pool()
+        Product = pool.get('product.product')
+        with Transaction().set_context(
+                stock_date_end=date, stock_skip_warehouse=True):
+            location_quantities = Product.products_by_location(
+                [warehouse_id], with_childs=True,
+                grouping_filter=(list(product_ids),))
+        return {p: location_quantities.get((warehouse_id, p), 0)
+            for p in product_ids}
+
+    @classmethod
+    def _store(cls, warehouse_id, quantities, date):
+        "Store the quantities of the products in the warehouse for the date"
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        columns = [
+            table.warehouse, table.product, table.date, table.quantity,
+            table.create_date, table.create_uid]
+        on_conflict = database.has_insert_on_conflict()
+        if not on_conflict:
+            cls.lock()
+        # Insert in the key order to avoid deadlocks
+        for sub_ids in grouped_slice(sorted(quantities)):
+            sub_ids = list(sub_ids)
+            values = [
+                [warehouse_id, p, date, quantities[p],
+                    CurrentTimestamp(), transaction.user]
+                for p in sub_ids]
+            if on_conflict:
+                cursor.execute(*table.insert(columns, values,
+                        on_conflict=Conflict(
+                            table,
+                            indexed_columns=[table.warehouse, table.product],
+                            columns=[
+                                table.date, table.quantity,
+                                table.write_date, table.write_uid],
+                            values=[
+                                Excluded.date, Excluded.quantity,
+                                CurrentTimestamp(), transaction.user])))
+            else:
+                cursor.execute(*table.delete(
+                        where=(table.warehouse == warehouse_id)
+                        & reduce_ids(table.product, sub_ids)))
+                cursor.execute(*table.insert(columns, values))
+
+    @classmethod
+    def invalidate(cls, keys):
+        "Delete the stored availability of the shop warehouse, product keys"
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        shop = Shop.__table__()
+
+        for sub_keys in grouped_slice(sorted(keys)):
+            cursor.execute(*table.delete(
+                    where=table.warehouse.in_(shop.select(shop.warehouse))
+                    & Or([
+                            (table.warehouse == w) & (table.product == p)
+                            for w, p in sub_keys])))
+
+
+class SaleShopMigration(ModelSQL):
+    'Sale Shop Migration'
+    __name__ = 'sale.shop.migration'
+
+    name = fields.Char("Name", required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('name_unique', Unique(t, t.name),
+                'sale_shop.msg_shop_migration_unique'),
+            ]
+
+    @classmethod
+    def pending(cls, model, names):
+        "Return the names of the migrations of the model not yet applied"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        keys = {'%s:%s' % (model, n): n for n in names}
+        cursor.execute(*table.select(
+                table.name, where=table.name.in_(list(keys))))
+        applied = {keys[n] for n, in cursor}
+        return set(names) - applied
+
+    @classmethod
+    def apply(cls, model, name, migration=None, count=None):
+        """Run the migration of the model and record it as applied
+
+        The migration is skipped if it is already applied.
+        A None migration records it as applied without running anything.
+        With the "migration_dry_run" option, the migration and the estimated
+        number of rows of the count query are only logged and nothing is
+        recorded.
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        key = '%s:%s' % (model, name)
+        if name not in cls.pending(model, [name]):
+            return
+        if MIGRATION_DRY_RUN:
+            if migration:
+                rows = None
+                if count is not None:
+                    cursor.execute(*count)
+                    rows, = cursor.fetchone()
+                logger.info(
+                    "migration %s would run on %s rows",
+                    key, '?' if rows is None else rows)
+            return
+        if migration:
+            logger.info("migration %s", key)
+            migration()
+        cursor.execute(*table.insert(
+                [table.name, table.create_date, table.create_uid],
+                [[key, CurrentTimestamp(), 0]]))
+
+
+class _ChangeDataManager:
+    "Insert the changes logged by the transaction just before its commit"
+
+    def __init__(self, model):
+        self.model = model
+        self.changes = []
+
+    def __eq__(self, other):
+        return isinstance(other, _ChangeDataManager)
+
+    def __hash__(self):
+        return hash(_ChangeDataManager)
+
+    def flush(self):
+        changes, self.changes = self.changes, []
+        self.model._insert(changes)
+
+    def tpc_begin(self, transaction):
+        pass
+
+    def commit(self, transaction):
+        self.flush()
+
+    def tpc_vote(self, transaction):
+        pass
+
+    def tpc_finish(self, transaction):
+        pass
+
+    def tpc_abort(self, transaction):
+        self.changes = []
+
+
+class SaleShopChange(ModelSQL):
+    'Sale Shop Change'
+    __name__ = 'sale.shop.change'
+
+    shop = fields.Many2One(
+        'sale.shop', "Shop", required=True, ondelete='CASCADE')
+    model = fields.Char("Model", required=True)
+    record = fields.Integer("Record", required=True)
+    operation = fields.Selection([
+            ('write', "Write"),
+            ('delete', "Delete"),
+            ('reset', "Reset"),
+            ], "Operation", required=True,
+        help="Reset records the last change removed by the compaction.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.shop, Index.Range()), (t.id, Index.Range())))
+
+    @classmethod
+    def log(cls, changes):
+        "Record the shop id, model name, record id and operation changes"
+        datamanager = Transaction().join(_ChangeDataManager(cls))
+        datamanager.changes.extend(changes)
+
+    @classmethod
+    def flush(cls):
+        "Insert the changes logged by the transaction"
+        Transaction().join(_ChangeDataManager(cls)).flush()
+
+    @classmethod
+    def _insert(cls, changes):
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        # The ids are allocated at insertion but become visible at commit so
+        # the insertions of a shop are serialized until the commit to keep
+        # its ids in commit order. Otherwise a client could receive a cursor
+        # after the id of a change not yet committed and never read it.
+        for shop in sorted({c[0] for c in changes}):
+            cursor.execute(*Select([database.lock_id(
+                            str2bigint('%s,%s' % (cls.__name__, shop)),
+                            timeout=True)]))
+        for sub_changes in grouped_slice(changes):
+            values = [
+                [shop, model, record, operation,
+                    CurrentTimestamp(), transaction.user]
+                for shop, model, record, operation in sub_changes]
+            if values:
+                cursor.execute(*table.insert([
+                            table.shop, table.model, table.record,
+                            table.operation,
+                            table.create_date, table.create_uid],
+                        values))
+
+    @classmethod
+    def get(cls, shop_id, cursor, limit):
+        "Return at most limit changes of the shop after cursor"
+        sql_cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        cls.flush()
+
+        if cursor is not None:
+            sql_cursor.execute(*table.select(
+                    Max(table.record),
+                    where=(table.shop == shop_id)
+                    & (table.operation == 'reset')))
+            reset, = sql_cursor.fetchone()
+        if cursor is None or (reset is not None and cursor < reset):
+            sql_cursor.execute(*table.select(
+                    Coalesce(Max(table.id), 0),
+                    where=table.shop == shop_id))
+            head, = sql_cursor.fetchone()
+            return None, head
+
+        sql_cursor.execute(*table.select(
+                table.id, table.model, table.record, table.operation,
+                where=(table.shop == shop_id)
+                & (table.id > cursor)
+                & (table.operation != 'reset'),
+                order_by=[table.id.asc],
+                limit=limit))
+        changes = {}
+        for change_id, model, record, operation in sql_cursor:
+            changes.pop((model, record), None)
+            changes[model, record] = operation
+            cursor = change_id
+        return [[m, r, o] for (m, r), o in changes.items()], cursor
+
+    @classmethod
+    def compact(cls):
+        '''
+        Keep only the last change of each record and remove the changes older
+        than the change_retention_days
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        older = cls.__table__()
+        newer = cls.__table__()
+
+        cls.flush()
+
+        cursor.execute(*table.delete(
+                where=(table.operation != 'reset')
+                & table.id.in_(older.join(newer,
+                        condition=(older.shop == newer.shop)
+                        & (older.model == newer.model)
+                        & (older.record == newer.record)
+                        & (older.id < newer.id)
+                        ).select(older.id))))
+
+        if not CHANGE_RETENTION_DAYS:
+            return
+        date = (dt.datetime.now()
+            - dt.timedelta(days=CHANGE_RETENTION_DAYS))
+        old = (table.create_date < date) & (table.operation != 'reset')
+        cursor.execute(*table.select(
+                table.shop, Max(table.id),
+                where=old,
+                group_by=[table.shop]))
+        resets = cursor.fetchall()
+        if not resets:
+            return
+        cursor.execute(*table.delete(
+                where=old
+                | ((table.operation == 'reset')
+                    & table.shop.in_([s for s, _ in resets]))))
+        cls.log((s, cls.__name__, r, 'reset') for s, r in resets)
@@ -5,13 +5,67 @@ from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 
+from .instrument import instrumented
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'stock.move'
+
+    @classmethod
+    def _shop_availability_fields(cls):
+        return {'state', 'product', 'quantity', 'unit', 'from_location',
+            'to_location', 'planned_date', 'effective_date'}
+
+    @classmethod
+    def _shop_availability_keys(cls, moves):
+        "Return the set of warehouse and product keys of the moves"
+        warehouses = {}
+        keys = set()
+        for move in moves:
+            for location in [move.from_location, move.to_location]:
+                if location not in warehouses:
+                    warehouses[location] = location.warehouse
+                if warehouses[location]:
+                    keys.add((warehouses[location].id, move.product.id))
+        return keys
+
+    @classmethod
+    def on_modification(cls, mode, moves, field_names=None):
+        pool = Pool()
+        Availability = pool.get('sale.shop.availability')
+        super().on_modification(mode, moves, field_names=field_names)
+        if mode == 'create':
+            Availability.invalidate(cls._shop_availability_keys(moves))
+
+    @classmethod
+    def on_write(cls, moves, values):
+        pool = Pool()
+        Availability = pool.get('sale.shop.availability')
+        callback = super().on_write(moves, values)
+        if values.keys() & cls._shop_availability_fields():
+            keys = cls._shop_availability_keys(moves)
+            ids = [m.id for m in moves]
+            callback.append(lambda: Availability.invalidate(
+                    keys | cls._shop_availability_keys(cls.browse(ids))))
+        return callback
+
+    @classmethod
+    def on_delete(cls, moves):
+        pool = Pool()
+        Availability = pool.get('sale.shop.availability')
+        callback = super().on_delete(moves)
+        keys = cls._shop_availability_keys(moves)
+        if keys:
+            callback.append(lambda: Availability.invalidate(keys))
+        return callback
+
 
 class ShipmentOut(metaclass=PoolMeta):
     __name__ = 'stock.shipment.out'
 
     shop_addresses = fields.Function(fields.Many2Many('party.address', None,
             None, 'Shop Addresses'),
-        'on_change_with_shop_addresses')
+        'get_shop_addresses')
 
     @classmethod
     def __setup__(cls):
@@ -35,10 +89,17 @@ class ShipmentOut(metaclass=PoolMeta):
         Shop = Pool().get('sale.shop')
         if not self.warehouse:
             return []
-        warehouse_shops = Shop.search([
-                ('warehouse', '=', self.warehouse.id),
-                ])
-        return [s.address.id for s in warehouse_shops if s.address]
+        addresses = Shop.get_warehouse_addresses([self.warehouse.id])
+        return list(addresses[self.warehouse.id])
+
+    @classmethod
+    @instrumented('stock.shipment.out.get_shop_addresses')
+    def get_shop_addresses(cls, shipments, name):
+        Shop = Pool().get('sale.shop')
+        addresses = Shop.get_warehouse_addresses(
+            {s.warehouse.id for s in shipments if s.warehouse})
+        return {s.id: list(addresses[s.warehouse.id]) if s.warehouse else []
+            for s in shipments}
 
 
 class ShipmentOutReturn(metaclass=PoolMeta):
@@ -46,7 +107,7 @@ class ShipmentOutReturn(metaclass=PoolMeta):
 
     shop_addresses = fields.Function(fields.Many2Many('party.address', None,
             None, 'Shop Addresses'),
-        'on_change_with_shop_addresses')
+        'get_shop_addresses')
 
     @classmethod
     def __setup__(cls):
@@ -70,7 +131,14 @@ class ShipmentOutReturn(metaclass=PoolMeta):
         Shop = Pool().get('sale.shop')
         if not self.warehouse:
             return []
-        warehouse_shops = Shop.search([
-                ('warehouse', '=', self.warehouse.id),
-                ])
-        return [s.address.id for s in warehouse_shops if s.address]
+        addresses = Shop.get_warehouse_addresses([self.warehouse.id])
+        return list(addresses[self.warehouse.id])
+
+    @classmethod
+    @instrumented('stock.shipment.out.return.get_shop_addresses')
+    def get_shop_addresses(cls, shipments, name):
+        Shop = Pool().get('sale.shop')
+        addresses = Shop.get_warehouse_addresses(
+            {s.warehouse.id for s in shipments if s.warehouse})
+        return {s.id: list(addresses[s.warehouse.id]) if s.warehouse else []
+            for s in shipments}
@@ -0,0 +1,181 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Micro-benchmarks of the sale_shop hot paths
+
+Run with the database configured like for the tests:
+
+    DB_NAME=:memory: TRYTOND_DATABASE_URI=sqlite:// \\
+        python -m trytond.modules.sale_shop.tests.benchmark --output out.json
+"""
+import argparse
+import json
+import sys
+import time
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, activate_module
+from trytond.transaction import Transaction
+
+from ..instrument import QueryCounter
+
+__all__ = ['run']
+
+
+def measure(func, iterations):
+    "Return the time and queries of calling func iterations times"
+    counter = QueryCounter(Transaction().connection)
+    with counter():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - start
+    return {
+        'iterations': iterations,
+        'time': elapsed,
+        'time_per_call': elapsed / iterations,
+        'queries': counter.count,
+        'queries_per_call': counter.count / iterations,
+        }
+
+
+def setup(shops, users, sales):
+    "Create the company, shops, users and sales to benchmark"
+    pool = Pool()
+    Company = pool.get('company.company')
+    Currency = pool.get('currency.currency')
+    Party = pool.get('party.party')
+    Location = pool.get('stock.location')
+    Sequence = pool.get('ir.sequence')
+    SequenceType = pool.get('ir.sequence.type')
+    Shop = pool.get('sale.shop')
+    User = pool.get('res.user')
+    Sale = pool.get('sale.sale')
+    ShipmentOut = pool.get('stock.shipment.out')
+
+    currency = Currency(name="Euro", symbol="€", code='EUR')
+    currency.save()
+    party = Party(name="Company", addresses=[{}])
+    party.save()
+    company = Company(party=party, currency=currency)
+    company.save()
+    address, = party.addresses
+    warehouse, = Location.search([('type', '=', 'warehouse')], limit=1)
+    sequence_type, = SequenceType.search([('name', '=', "Sale")], limit=1)
+
+    with Transaction().set_context(company=company.id):
+        shops = Shop.create([{
+                    'name': "Shop %s" % i,
+                    'company': company.id,
+                    'warehouse': warehouse.id,
+                    'address': address.id,
+                    'sale_sequence': Sequence.create([{
+                                'name': "Shop %s" % i,
+                                'sequence_type': sequence_type.id,
+                                }])[0].id,
+                    } for i in range(shops)])
+        users = User.create([{
+                    'name': "User %s-%s" % (shop.id, i),
+                    'login': 'user-%s-%s' % (shop.id, i),
+                    'companies': [('add', [company.id])],
+                    'company': company.id,
+                    'shops': [('add', [shop.id])],
+                    'shop': shop.id,
+                    } for shop in shops for i in range(users)])
+        customer = Party(name="Customer", addresses=[{}])
+        customer.save()
+        customer_address, = customer.addresses
+        with Transaction().set_context(shops=[s.id for s in shops]):
+            sales = Sale.create([{
+                        'company': company.id,
+                        'shop': shops[i % len(shops)].id,
+                        'party': customer.id,
+                        } for i in range(sales)])
+        shipments = ShipmentOut.create([{
+                    'company': company.id,
+                    'customer': customer.id,
+                    'delivery_address': customer_address.id,
+                    'warehouse': warehouse.id,
+                    'warehouse_output': warehouse.output_location.id,
+                    'warehouse_storage': warehouse.storage_location.id,
+                    } for _ in range(len(sales))])
+    return company, shops, users, sales, shipments
+
+
+def run(shops=5, users=2, sales=100, iterations=100):
+    "Run the benchmarks and return the results"
+    pool = Pool()
+    Sale = pool.get('sale.sale')
+    Rule = pool.get('ir.rule')
+    ShipmentOut = pool.get('stock.shipment.out')
+    transaction = Transaction()
+
+    parameters = {
+        'shops': shops,
+        'users': users,
+        'sales': sales,
+        'iterations': iterations,
+        }
+    company, shops, users, sales, shipments = setup(shops, users, sales)
+    user = users[0]
+    sale_fields = list(Sale._fields.keys())
+
+    results = {}
+    with transaction.set_user(user.id), \
+            transaction.set_context(
+                company=company.id, shop=user.shop.id,
+                shops=[s.id for s in user.shops], _check_access=True):
+        results['sale.default_get'] = measure(
+            lambda: Sale.default_get(sale_fields, with_rec_name=False),
+            iterations)
+
+        def on_change_shop():
+            sale = Sale(shop=user.shop, party=sales[0].party)
+            sale.on_change_shop()
+        results['sale.on_change_shop'] = measure(on_change_shop, iterations)
+
+        def domain_get():
+            Rule._domain_get_cache.clear()
+            Rule.domain_get('sale.sale')
+        results['ir.rule.domain_get'] = measure(domain_get, iterations)
+
+    shipment_ids = [s.id for s in shipments]
+    results['stock.shipment.out.shop_addresses'] = measure(
+        lambda: ShipmentOut.read(shipment_ids, ['shop_addresses']),
+        iterations)
+
+    results['sale.set_number'] = measure(
+        lambda: Sale.set_number(Sale.browse(sales)), 1)
+
+    return {
+        'backend': backend.name,
+        'parameters': parameters,
+        'results': results,
+        }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shops', type=int, default=5)
+    parser.add_argument('--users', type=int, default=2,
+        help="the number of users per shop")
+    parser.add_argument('--sales', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--output', type=argparse.FileType('w'),
+        default=sys.stdout)
+    options = parser.parse_args(args)
+
+    activate_module('sale_shop')
+    with Transaction().start(DB_NAME, 0) as transaction:
+        try:
+            result = run(
+                shops=options.shops, users=options.users,
+                sales=options.sales, iterations=options.iterations)
+        finally:
+            transaction.rollback()
+    json.dump(result, options.output, indent=2)
+    options.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
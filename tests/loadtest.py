@@ -0,0 +1,232 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Concurrent load test of the point of sale of many shops
+
+Run against a local PostgreSQL database, it is dropped and recreated:
+
+    DB_NAME=loadtest TRYTOND_DATABASE_URI=postgresql:// \\
+        python -m trytond.modules.sale_shop.tests.loadtest --output out.json
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from unittest.mock import patch
+
+from proteus import Model
+from proteus import config as pconfig
+from trytond import backend
+from trytond.modules.account_invoice.tests.tools import create_payment_term
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.pool import Pool
+from trytond.tests.tools import activate_modules
+
+from .tools import create_shop
+
+__all__ = ['run']
+
+
+class SequenceWaits:
+    "Record the time spent to get the numbers of each sale sequence"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.waits = defaultdict(list)
+
+    def add(self, sequence_id, duration):
+        with self._lock:
+            self.waits[sequence_id].append(duration)
+
+    def __call__(self, func):
+        def wrapper(cls, sequence, n, cache=None):
+            start = time.perf_counter()
+            try:
+                return func(sequence, n, cache)
+            finally:
+                self.add(sequence.id, time.perf_counter() - start)
+        return classmethod(wrapper)
+
+
+def percentiles(values, ps=(50, 90, 95, 99)):
+    "Return the percentiles and the maximum of the values"
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {
+        'p%s' % p: values[min(len(values) - 1, len(values) * p // 100)]
+        for p in ps}
+    result['max'] = values[-1]
+    return result
+
+
+def setup(config, shops, users):
+    "Create the shops with their own sequence, their users and a product"
+    Company = Model.get('company.company')
+    Group = Model.get('res.group')
+    Party = Model.get('party.party')
+    PriceList = Model.get('product.price_list')
+    ProductTemplate = Model.get('product.template')
+    ProductUom = Model.get('product.uom')
+    Sequence = Model.get('ir.sequence')
+    SequenceType = Model.get('ir.sequence.type')
+    Shop = Model.get('sale.shop')
+    User = Model.get('res.user')
+
+    create_company(config=config)
+    company = get_company(config=config)
+    payment_term = create_payment_term()
+    payment_term.save()
+    price_list = PriceList(name="Retail", price='list_price')
+    price_list.lines.new(formula='unit_price')
+    price_list.save()
+
+    unit, = ProductUom.find([('name', '=', "Unit")])
+    template = ProductTemplate(
+        name="Product", default_uom=unit, type='service', salable=True,
+        sale_uom=unit, list_price=Decimal(10))
+    template.save()
+    product, = template.products
+    customer = Party(name="Customer")
+    customer.addresses.new()
+    customer.save()
+
+    sequence_type, = SequenceType.find([('name', '=', "Sale")])
+    groups = [g.id for g in Group.find(
+            [('name', 'in', ["Sales", "Sales Administrator"])])]
+    tills = []
+    for i in range(shops):
+        sequence = Sequence(
+            name="Shop %s" % i, sequence_type=sequence_type,
+            company=company)
+        sequence.save()
+        shop = create_shop(
+            payment_term, price_list, name="Shop %s" % i, sequence=sequence,
+            config=config)
+        shop.save()
+        for j in range(users):
+            user = User(
+                name="Till %s-%s" % (i, j), login='till-%s-%s' % (i, j))
+            user.companies.append(Company(company.id))
+            user.company = company
+            user.shops.append(Shop(shop.id))
+            user.shop = shop
+            user.groups.extend([Group(g) for g in groups])
+            user.save()
+            tills.append((shop.name, user.login))
+    return customer.id, product.id, tills
+
+
+def till(config, customer_id, product_id, sales, lines):
+    "Open, fill, quote and confirm the sales and return their latencies"
+    Sale = Model.get('sale.sale', config=config)
+    Party = Model.get('party.party', config=config)
+    Product = Model.get('product.product', config=config)
+
+    customer = Party(customer_id)
+    product = Product(product_id)
+    latencies, errors = [], []
+    for _ in range(sales):
+        start = time.perf_counter()
+        try:
+            sale = Sale()
+            sale.party = customer
+            for _ in range(lines):
+                line = sale.lines.new()
+                line.product = product
+                line.quantity = 1
+            sale.click('quote')
+            sale.click('confirm')
+        except Exception as exception:
+            errors.append(
+                ''.join(traceback.format_exception_only(exception)).strip())
+        else:
+            latencies.append(time.perf_counter() - start)
+    return latencies, errors
+
+
+def run(shops=5, users=2, sales=20, lines=3, workers=None):
+    "Run the load test and return the results"
+    config = activate_modules('sale_shop')
+    parameters = {
+        'shops': shops,
+        'users': users,
+        'sales': sales,
+        'lines': lines,
+        'workers': workers or shops * users,
+        }
+    customer_id, product_id, tills = setup(config, shops, users)
+    # The configurations are created before the threads as they initialize
+    # the pool
+    configs = [
+        (shop, pconfig.set_trytond(user=login)) for shop, login in tills]
+
+    Shop = Pool(config.database_name).get('sale.shop')
+    waits = SequenceWaits()
+    with patch.object(
+            Shop, 'get_sale_numbers', waits(Shop.get_sale_numbers)):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=parameters['workers']) as pool:
+            futures = [
+                (shop, pool.submit(
+                        till, till_config, customer_id, product_id, sales,
+                        lines))
+                for shop, till_config in configs]
+            results = [(shop, f.result()) for shop, f in futures]
+        elapsed = time.perf_counter() - start
+
+    latencies, failures, errors = [], Counter(), Counter()
+    for shop, (till_latencies, till_errors) in results:
+        latencies.extend(till_latencies)
+        failures[shop] += len(till_errors)
+        errors.update(till_errors)
+
+    Sequence = Model.get('ir.sequence', config=config)
+    sequence_names = {
+        s: Sequence(s).name for s in waits.waits}
+    return {
+        'backend': backend.name,
+        'parameters': parameters,
+        'results': {
+            'sales': len(latencies),
+            'time': elapsed,
+            'throughput': len(latencies) / elapsed,
+            'latency': percentiles(latencies),
+            'sequence_waits': {
+                sequence_names[s]: dict(
+                    calls=len(w), time=sum(w), **percentiles(w))
+                for s, w in waits.waits.items()},
+            'failures': dict(failures),
+            'errors': dict(errors.most_common(10)),
+            },
+        }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shops', type=int, default=5)
+    parser.add_argument('--users', type=int, default=2,
+        help="the number of till users per shop")
+    parser.add_argument('--sales', type=int, default=20,
+        help="the number of sales per till user")
+    parser.add_argument('--lines', type=int, default=3,
+        help="the number of lines per sale")
+    parser.add_argument('--workers', type=int,
+        help="the number of threads, by default one per till user")
+    parser.add_argument('--output', type=argparse.FileType('w'),
+        default=sys.stdout)
+    options = parser.parse_args(args)
+
+    result = run(
+        shops=options.shops, users=options.users, sales=options.sales,
+        lines=options.lines, workers=options.workers)
+    json.dump(result, options.output, indent=2)
+    options.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,48 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime as dt
+import json
+import logging
+import threading
+import unittest
+from contextlib import contextmanager, nullcontext
+from decimal import Decimal
+from unittest.mock import MagicMock, Mock, patch
+
+from sql import Column, Literal, Null, Table
+from sql.aggregate import Count
+
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.model.exceptions import AccessError
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.sale_shop import (
+    ir, sale as sale_module, shop as shop_module, user as user_module)
+from trytond.modules.sale_shop.instrument import QueryCounter, instrument
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+def create_shop(company, name='Shop', **values):
+    pool = Pool()
+    Shop = pool.get('sale.shop')
+    Location = pool.get('stock.location')
+
+    warehouse, = Location.search([('type', '=', 'warehouse')], limit=1)
+    shop = Shop(name=name, company=company, warehouse=warehouse, **values)
+    shop.save()
+    return shop
+
+
+def set_user_shop(shop, *shops):
+    pool = Pool()
+    User = pool.get('res.user')
+    User.write([User(Transaction().user)], {
+            'shops': [('add', [s.id for s in (shop,) + shops])],
+            'shop': shop.id,
+            })
 
 
 class SaleShopCompanyTestMixin(CompanyTestMixin):
@@ -18,5 +58,1318 @@ class SaleShopTestCase(SaleShopCompanyTestMixin, ModuleTestCase):
     'Test SaleShop module'
     module = 'sale_shop'
 
+    @with_transaction()
+    def test_sale_default_shop(self):
+        "Test sale defaults from user shop"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            shop1 = create_shop(company, 'Shop 1',
+                sale_invoice_method='manual',
+                sale_shipment_method='invoice')
+            shop2 = create_shop(company, 'Shop 2')
+            set_user_shop(shop1, shop2)
+
+            self.assertEqual(Sale.default_shop(), shop1.id)
+            self.assertEqual(Sale.default_company(), company.id)
+            self.assertEqual(Sale.default_warehouse(), shop1.warehouse.id)
+            self.assertEqual(Sale.default_invoice_method(), 'manual')
+            self.assertEqual(Sale.default_shipment_method(), 'invoice')
+
+            shop1.sale_invoice_method = 'order'
+            shop1.save()
+            self.assertEqual(Sale.default_invoice_method(), 'order')
+
+            set_user_shop(shop2)
+            self.assertEqual(Sale.default_shop(), shop2.id)
+
+    @with_transaction()
+    def test_user_get_shops_cache(self):
+        "Test user shops are cached and invalidated"
+        pool = Pool()
+        User = pool.get('res.user')
+        UserShop = pool.get('sale.shop-res.user')
+
+        company = create_company()
+        with set_company(company):
+            shop1 = create_shop(company, 'Shop 1')
+            shop2 = create_shop(company, 'Shop 2')
+            set_user_shop(shop1)
+
+            self.assertEqual(User.get_shop(), shop1.id)
+            self.assertEqual(User.get_shops(), (shop1.id,))
+
+            user_shop = UserShop(user=Transaction().user, shop=shop2)
+            user_shop.save()
+            self.assertEqual(set(User.get_shops()), {shop1.id, shop2.id})
+
+            UserShop.delete([user_shop])
+            self.assertEqual(User.get_shops(), (shop1.id,))
+
+            User.write([User(Transaction().user)], {'shop': None})
+            self.assertEqual(User.get_shop(), None)
+
+    @with_transaction()
+    def test_user_preferences_shops(self):
+        "Test user preferences with shops"
+        pool = Pool()
+        User = pool.get('res.user')
+        Shop = pool.get('sale.shop')
+
+        company = create_company()
+        with set_company(company):
+            shop1 = create_shop(company, 'Shop B')
+            shop2 = create_shop(company, 'Shop A')
+            set_user_shop(shop1, shop2)
+
+            with patch.object(user_module, 'PREFERENCES_SHOP_CATALOG', True):
+                preferences = User.get_preferences()
+            user = User(Transaction().user)
+
+            self.assertEqual(preferences['shop'], shop1.id)
+            self.assertEqual(preferences['shops'], [shop2.id, shop1.id])
+            self.assertEqual(preferences['shops.catalog'], [
+                    [shop2.id, 'Shop A', company.id],
+                    [shop1.id, 'Shop B', company.id],
+                    ])
+            self.assertTrue(user.status_bar.endswith(' - Shop B'))
+
+            Shop.write([shop1], {'name': 'Shop C'})
+            self.assertEqual(
+                User._get_shop_catalog()[-1], (shop1.id, 'Shop C', company.id))
+
+    @with_transaction()
+    def test_user_on_change_company(self):
+        "Test user on change company selects the shop"
+        pool = Pool()
+        User = pool.get('res.user')
+
+        company1 = create_company()
+        company2 = create_company()
+        with set_company(company1):
+            shop1 = create_shop(company1, 'Shop 1')
+            shop2 = create_shop(company1, 'Shop 2')
+        with set_company(company2):
+            shop3 = create_shop(company2, 'Shop 3')
+        user = User(Transaction().user)
+        User.write([user], {
+                'companies': [('add', [company1.id, company2.id])],
+                'company': company1.id,
+                'shops': [('add', [shop1.id, shop2.id, shop3.id])],
+                })
+
+        user = User(user.id)
+        user.company = company2
+        user.on_change_company()
+        self.assertEqual(user.shop, shop3)
+
+        user.company = company1
+        user.on_change_company()
+        self.assertEqual(user.shop, None)
+
+        User.write([user], {'company': company1.id, 'shop': shop2.id})
+        User.write([user], {'company': company2.id, 'shop': shop3.id})
+        user = User(user.id)
+        user.company = company1
+        user.on_change_company()
+        self.assertEqual(user.shop, shop2)
+
+    @with_transaction()
+    def test_shop_group_access(self):
+        "Test user access to the shops through the group hierarchy"
+        pool = Pool()
+        User = pool.get('res.user')
+        Shop = pool.get('sale.shop')
+        Group = pool.get('sale.shop.group')
+        Closure = pool.get('sale.shop.group.closure')
+
+        def closure():
+            return sorted(
+                (c.ancestor.name, c.descendant.name, c.depth)
+                for c in Closure.search([]))
+
+        company = create_company()
+        with set_company(company):
+            region, = Group.create([{
+                        'name': "Region",
+                        'children': [('create', [{
+                                        'name': "Area",
+                                        'children': [('create', [{
+                                                        'name': "Zone",
+                                                        }])],
+                                        }])],
+                        }])
+            area, = region.children
+            zone, = area.children
+            shop1 = create_shop(company, 'Shop 1', group=zone)
+            shop2 = create_shop(company, 'Shop 2')
+            shop3 = create_shop(company, 'Shop 3')
+            set_user_shop(shop2)
+            User.write([User(Transaction().user)], {
+                    'shop_groups': [('add', [region.id])],
+                    })
+
+            self.assertEqual(closure(), [
+                    ("Area", "Area", 0),
+                    ("Area", "Zone", 1),
+                    ("Region", "Area", 1),
+                    ("Region", "Region", 0),
+                    ("Region", "Zone", 2),
+                    ("Zone", "Zone", 0),
+                    ])
+            self.assertEqual(User.get_shops(), (shop1.id, shop2.id))
+
+            Shop.write([shop3], {'group': area.id})
+            self.assertEqual(
+                User.get_shops(), (shop1.id, shop2.id, shop3.id))
+            self.assertEqual(
+                Shop.search([('current_user_shop', '=', True)],
+                    order=[('id', 'ASC')]),
+                [shop1, shop2, shop3])
+
+            Group.write([area], {'parent': None})
+            self.assertEqual(closure(), [
+                    ("Area", "Area", 0),
+                    ("Area", "Zone", 1),
+                    ("Region", "Region", 0),
+                    ("Zone", "Zone", 0),
+                    ])
+            self.assertEqual(User.get_shops(), (shop2.id,))
+
+            Group.write([zone], {'parent': region.id})
+            self.assertEqual(User.get_shops(), (shop1.id, shop2.id))
+            self.assertIn(("Region", "Zone", 1), closure())
+            self.assertNotIn(("Area", "Zone", 1), closure())
+
+        # The users can not give themselves the shops of a group
+        GroupUser = pool.get('sale.shop.group-res.user')
+        ModelData = pool.get('ir.model.data')
+        transaction = Transaction()
+        user, = User.create([{
+                    'name': "Seller",
+                    'login': 'seller',
+                    'groups': [('add', [
+                                ModelData.get_id('sale', 'group_sale')])],
+                    'companies': [('add', [company.id])],
+                    'company': company.id,
+                    }])
+        with transaction.set_user(user.id), \
+                transaction.set_context(_check_access=True):
+            self.assertTrue(Closure.search([]))
+            for Model, values in [
+                    (GroupUser, {'group': region.id, 'user': user.id}),
+                    (Closure, {
+                            'ancestor': region.id, 'descendant': region.id,
+                            'depth': 0}),
+                    ]:
+                with self.subTest(model=Model.__name__):
+                    with self.assertRaises(AccessError):
+                        Model.create([values])
+            for name in ['res.user.company_shop', 'sale.shop.change']:
+                with self.subTest(model=name):
+                    with self.assertRaises(AccessError):
+                        pool.get(name).search([])
+
+    @with_transaction()
+    def test_sale_settings(self):
+        "Test sale settings fall back to the configuration"
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Configuration = pool.get('sale.configuration')
+        Sequence = pool.get('ir.sequence')
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            shop = create_shop(company)
+            config = Configuration(1)
+            config.sale_invoice_method = 'manual'
+            config.save()
+
+            settings = Shop.get_sale_settings([shop.id])[shop.id]
+            self.assertEqual(settings.company, company.id)
+            self.assertEqual(settings.currency, company.currency.id)
+            self.assertEqual(settings.invoice_method, 'manual')
+            self.assertEqual(
+                settings.sale_sequence, config.sale_sequence.id)
+            self.assertEqual(settings.sale_sequence_cache, None)
+
+            config.sale_invoice_method = 'shipment'
+            config.save()
+            settings = Shop.get_sale_settings([shop.id])[shop.id]
+            self.assertEqual(settings.invoice_method, 'shipment')
+
+            sequence, = Sequence.copy([config.sale_sequence])
+            shop.sale_invoice_method = 'order'
+            shop.sale_sequence = sequence
+            shop.sale_sequence_cache = 10
+            shop.save()
+            settings = Shop.get_sale_settings([shop.id])[shop.id]
+            self.assertEqual(settings.invoice_method, 'order')
+            self.assertEqual(settings.sale_sequence, sequence.id)
+            self.assertEqual(settings.sale_sequence_cache, 10)
+            with self.assertRaises(AttributeError):
+                settings.invoice_method = 'manual'
+
+            set_user_shop(shop)
+            self.assertEqual(Sale.default_invoice_method(), 'order')
+            self.assertEqual(
+                Sale.default_invoice_method(company=-5),
+                config.get_multivalue('sale_invoice_method', company=-5))
+
+    @with_transaction()
+    def test_apply_shop_defaults(self):
+        "Test apply shop defaults matches on_change_shop"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Party = pool.get('party.party')
+        PriceList = pool.get('product.price_list')
+
+        company = create_company()
+        with set_company(company):
+            shop_price_list = PriceList(name="Shop", company=company)
+            shop_price_list.save()
+            party_price_list = PriceList(name="Party", company=company)
+            party_price_list.save()
+            shop = create_shop(company, price_list=shop_price_list,
+                sale_invoice_method='manual')
+            party = Party(name="Customer")
+            party.save()
+            party_with_list = Party(
+                name="Customer", sale_price_list=party_price_list)
+            party_with_list.save()
+
+            for party in [party, party_with_list]:
+                with self.subTest(party=party):
+                    sale = Sale(party=party, shop=shop)
+                    sale.on_change_party()
+                    sale.on_change_shop()
+                    values, = Sale.apply_shop_defaults([{
+                                'party': party.id,
+                                'shop': shop.id,
+                                }])
+                    for fname in ['company', 'warehouse', 'currency',
+                            'price_list', 'invoice_method']:
+                        value = getattr(sale, fname)
+                        self.assertEqual(
+                            values.get(fname),
+                            getattr(value, 'id', value), msg=fname)
+
+            other = create_shop(company, 'Other', sale_invoice_method='order')
+            set_user_shop(other, shop)
+            with Transaction().set_context(shops=[shop.id, other.id]):
+                sale, = Sale.create([{
+                            'party': party_with_list.id,
+                            'shop': shop.id,
+                            }])
+            self.assertEqual(sale.invoice_method, 'manual')
+            self.assertEqual(sale.price_list, party_price_list)
+            self.assertEqual(sale.warehouse, shop.warehouse)
+
+            # The empty values do not come from the user shop
+            empty = create_shop(company, 'Empty')
+            set_user_shop(shop, empty)
+            with Transaction().set_context(shops=[shop.id, empty.id]):
+                sale, = Sale.create([{
+                            'party': party.id,
+                            'shop': empty.id,
+                            }])
+            self.assertEqual(sale.invoice_method, 'order')
+            self.assertEqual(sale.shipment_method, 'order')
+            self.assertEqual(sale.shop, empty)
+
+    @with_transaction()
+    def test_warehouse_addresses(self):
+        "Test shop addresses per warehouse"
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+
+        company = create_company()
+        with set_company(company):
+            address, = company.party.addresses
+            shop = create_shop(company)
+            warehouse = shop.warehouse
+
+            self.assertEqual(
+                Shop.get_warehouse_addresses([warehouse.id]),
+                {warehouse.id: ()})
+
+            shop.address = address
+            shop.save()
+            self.assertEqual(
+                Shop.get_warehouse_addresses([warehouse.id]),
+                {warehouse.id: (address.id,)})
+
+            shop.active = False
+            shop.save()
+            self.assertEqual(
+                Shop.get_warehouse_addresses([warehouse.id]),
+                {warehouse.id: ()})
+
+    @with_transaction()
+    def test_get_sale_numbers(self):
+        "Test get sale numbers"
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Sequence = pool.get('ir.sequence')
+        SequenceType = pool.get('ir.sequence.type')
+
+        sequence_type, = SequenceType.search([
+                ('name', '=', "Sale"),
+                ], limit=1)
+        sequence = Sequence(name="Sale", sequence_type=sequence_type)
+        sequence.save()
+
+        self.assertEqual(Shop.get_sale_numbers(sequence, 3), ['1', '2', '3'])
+        self.assertEqual(Shop.get_sale_numbers(sequence, 1), ['4'])
+
+    @with_transaction()
+    def test_get_sale_numbers_cache(self):
+        "Test get sale numbers from reserved blocks"
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Sequence = pool.get('ir.sequence')
+        SequenceStrict = pool.get('ir.sequence.strict')
+        SequenceType = pool.get('ir.sequence.type')
+        transaction = Transaction()
+
+        sequence_type, = SequenceType.search([
+                ('name', '=', "Sale"),
+                ], limit=1)
+        sequence = Sequence(name="Sale", sequence_type=sequence_type)
+        sequence.save()
+        strict = SequenceStrict(name="Strict", sequence_type=sequence_type)
+        strict.save()
+
+        # Reserve the blocks in the test transaction
+        with patch.object(transaction, 'new_transaction', nullcontext):
+            self.assertEqual(
+                Shop.get_sale_numbers(sequence, 2, 5), ['1', '2'])
+            self.assertEqual(Shop.get_sale_numbers(sequence, 1, 5), ['3'])
+            self.assertEqual(Sequence(sequence.id).number_next, 6)
+
+            sequence.number_next = 100
+            sequence.save()
+            self.assertEqual(Shop.get_sale_numbers(sequence, 1, 5), ['100'])
+
+            sequence.prefix = 'S'
+            sequence.save()
+            self.assertEqual(
+                Shop.get_sale_numbers(sequence, 1, 5), ['S105'])
+
+            self.assertEqual(Shop.get_sale_numbers(strict, 1, 5), ['1'])
+            self.assertEqual(SequenceStrict(strict.id).number_next, 2)
+
+        @contextmanager
+        def new_transaction():
+            # The other workers can take the numbers left while reserving
+            key = (transaction.database.name, sequence.id)
+            self.assertFalse(shop_module._sale_numbers_locks[key].locked())
+            yield
+
+        with patch.object(transaction, 'new_transaction', new_transaction):
+            self.assertEqual(
+                Shop.get_sale_numbers(sequence, 5, 5)[:4],
+                ['S106', 'S107', 'S108', 'S109'])
+
+    @with_transaction()
+    def test_migrate_property(self):
+        "Test migration of shop properties"
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Field = pool.get('ir.model.field')
+        Sequence = pool.get('ir.sequence')
+        SequenceType = pool.get('ir.sequence.type')
+        cursor = Transaction().connection.cursor()
+        shop_table = Shop.__table__()
+        property_ = Table('ir_property')
+
+        company = create_company()
+        with set_company(company):
+            shops = [create_shop(company, 'Shop %s' % i) for i in range(3)]
+        sequence_type, = SequenceType.search([
+                ('name', '=', "Sale"),
+                ], limit=1)
+        sequence = Sequence(name="Sale", sequence_type=sequence_type)
+        sequence.save()
+
+        cursor.execute('CREATE TABLE ir_property ('
+            'id INTEGER, field INTEGER, res VARCHAR, value VARCHAR)')
+        properties = {
+            'sale_sequence': [
+                'ir.sequence,%s' % sequence.id, 'ir.sequence,', None],
+            'sale_invoice_method': [
+                ',manual', ',shipment', ','],
+            }
+        for field_name, values in properties.items():
+            field, = Field.search([
+                    ('model', '=', 'sale.shop'),
+                    ('name', '=', field_name),
+                    ])
+            cursor.execute(*property_.insert(
+                    [property_.field, property_.res, property_.value],
+                    [[field.id, 'sale.shop,%s' % s.id, v]
+                        for s, v in zip(shops, values)]))
+            cursor.execute(*shop_table.update(
+                    [Column(shop_table, field_name)], [Null]))
+
+        expected = {}
+        for field_name, values in properties.items():
+            for shop, value in zip(shops, values):
+                value = value.split(',')[1] if value else None
+                if value and field_name == 'sale_sequence':
+                    value = int(value)
+                expected[shop.id, field_name] = value or None
+
+            Shop._migrate_property(field_name)
+
+        cursor.execute(*shop_table.select(
+                shop_table.id, shop_table.sale_sequence,
+                shop_table.sale_invoice_method))
+        result = {}
+        for shop_id, sale_sequence, sale_invoice_method in cursor:
+            result[shop_id, 'sale_sequence'] = sale_sequence
+            result[shop_id, 'sale_invoice_method'] = sale_invoice_method
+        self.assertEqual(result, expected)
+
+    @with_transaction()
+    def test_register_currency(self):
+        "Test register fills shop currency from company once"
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Migration = pool.get('sale.shop.migration')
+        cursor = Transaction().connection.cursor()
+        shop_table = Shop.__table__()
+        migration_table = Migration.__table__()
+
+        company = create_company()
+        with set_company(company):
+            shop = create_shop(company)
+
+        def register():
+            cursor.execute(*shop_table.update(
+                    [shop_table.currency], [Null],
+                    where=shop_table.id == shop.id))
+            Shop.__register__('sale_shop')
+            cursor.execute(*shop_table.select(
+                    shop_table.currency, where=shop_table.id == shop.id))
+            return cursor.fetchone()
+
+        self.assertEqual(register(), (None,))
+
+        cursor.execute(*migration_table.delete(
+                where=migration_table.name == 'sale.shop:currency'))
+        self.assertEqual(register(), (company.currency.id,))
+
+    @with_transaction()
+    def test_get_shop_sales(self):
+        "Test keyset pagination of shop sales"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            shop = create_shop(company)
+            set_user_shop(shop)
+            party = Party(name="Customer")
+            party.save()
+            with Transaction().set_context(shops=[shop.id]):
+                sales = Sale.create([{
+                            'party': party.id,
+                            'sale_date': d,
+                            } for d in [
+                            None, None, dt.date(2020, 1, 1),
+                            dt.date(2020, 1, 2), dt.date(2020, 1, 2)]])
+
+            pages, cursor = [], None
+            while True:
+                page, cursor = Sale.get_shop_sales(
+                    shop.id, cursor=cursor, limit=2)
+                pages.append(page)
+                if not cursor:
+                    break
+
+            for cursor in ['invalid', 'WzFd', 'WyJ4IiwgMV0=']:
+                with self.subTest(cursor=cursor):
+                    with self.assertRaisesRegex(UserError, "not valid"):
+                        Sale.get_shop_sales(shop.id, cursor=cursor)
+
+        self.assertEqual([len(p) for p in pages], [2, 2, 1])
+        self.assertEqual(
+            [r[0] for p in pages for r in p],
+            [s.id for s in [
+                    sales[1], sales[0], sales[4], sales[3], sales[2]]])
+        self.assertEqual(pages[0][0][2], "Customer")
+
+    @with_transaction()
+    def test_apply_settings(self):
+        "Test apply shop settings to open sales"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Shop = pool.get('sale.shop')
+        Party = pool.get('party.party')
+        Queue = pool.get('ir.queue')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        transaction = Transaction()
+
+        unit, = Uom.search([('name', '=', "Unit")])
+        company = create_company()
+        with set_company(company):
+            template = Template(
+                name="Product", default_uom=unit, list_price=Decimal(10),
+                salable=True, sale_uom=unit)
+            template.save()
+            product = Product(template=template)
+            product.save()
+            shop = create_shop(company, sale_invoice_method='manual')
+            set_user_shop(shop)
+            party = Party(name="Customer")
+            party.save()
+            with transaction.set_context(shops=[shop.id]):
+                sales = Sale.create([{
+                            'party': party.id,
+                            'lines': [('create', [{
+                                            'product': product.id,
+                                            'quantity': 1,
+                                            'unit': unit.id,
+                                            'unit_price': Decimal(10),
+                                            }])],
+                            }] * 3)
+                Sale.write(sales[-1:], {'state': 'cancelled'})
+
+            shop.sale_invoice_method = 'order'
+            shop.save()
+            with patch.object(shop_module, 'APPLY_SETTINGS_CHUNK', 1):
+                Shop.apply_settings([shop])
+            self.assertEqual(len(transaction.tasks), 2)
+            for task_id in transaction.tasks:
+                Queue(task_id).run()
+
+        self.assertEqual(
+            [s.invoice_method for s in Sale.browse(sales)],
+            ['order', 'order', 'manual'])
+        shop = Shop(shop.id)
+        self.assertEqual(shop.settings_sales_total, 2)
+        self.assertEqual(shop.settings_progress, 1)
+
+        # The lines are re-priced together
+        with set_company(company):
+            template.list_price = Decimal(20)
+            template.save()
+            with patch.object(Product, 'get_sale_price',
+                    wraps=Product.get_sale_price) as get_sale_price:
+                Sale.apply_shop_settings(Sale.browse(sales))
+            get_sale_price.assert_called_once()
+            self.assertEqual(
+                [s.lines[0].unit_price for s in Sale.browse(sales)],
+                [Decimal(20), Decimal(20), Decimal(10)])
+
+    @with_transaction()
+    def test_get_availability(self):
+        "Test shop availability is stored on read and invalidated by moves"
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Availability = pool.get('sale.shop.availability')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        unit, = Uom.search([('name', '=', "Unit")])
+        template = Template(name="Product", type='goods', default_uom=unit)
+        template.save()
+        product = Product(template=template)
+        product.save()
+        supplier, = Location.search([('code', '=', 'SUP')])
+
+        company = create_company()
+        with set_company(company):
+            shop = create_shop(company)
+            self.assertEqual(
+                Shop.get_availability(shop, [product.id]), {product.id: 0})
+            self.assertEqual(Availability.search([], count=True), 1)
+
+            move = Move(
+                product=product, unit=unit, quantity=5,
+                from_location=supplier,
+                to_location=shop.warehouse.storage_location,
+                unit_price=1, currency=company.currency)
+            move.save()
+            self.assertEqual(Availability.search([], count=True), 0)
+            Move.do([move])
+            with instrument() as stats:
+                for _ in range(2):
+                    self.assertEqual(
+                        Shop.get_availability(shop, [product.id]),
+                        {product.id: 5})
+            self.assertEqual(
+                stats['sale.shop.get_availability']['misses'], 1)
+            self.assertEqual(
+                stats['sale.shop.get_availability']['hits'], 1)
+            availability, = Availability.search([])
+            self.assertEqual(availability.quantity, 5)
+
+            # The stale quantity of another day is replaced
+            Availability.write([availability], {
+                    'date': availability.date - dt.timedelta(days=1),
+                    'quantity': 0,
+                    })
+            self.assertEqual(
+                Shop.get_availability(shop, [product.id]), {product.id: 5})
+            availability, = Availability.search([])
+            self.assertEqual(availability.quantity, 5)
+
+    @with_transaction()
+    def test_get_prices(self):
+        "Test shop prices are cached by company and invalidated by prices"
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        PriceList = pool.get('product.price_list')
+
+        unit, = Uom.search([('name', '=', "Unit")])
+        company = create_company()
+        with set_company(company):
+            template = Template(
+                name="Product", default_uom=unit, list_price=Decimal(10),
+                salable=True, sale_uom=unit)
+            template.save()
+            product = Product(template=template)
+            product.save()
+            price_list = PriceList(
+                name="Shop", company=company, price='list_price', lines=[{
+                        'quantity': 5,
+                        'formula': 'unit_price * 0.8',
+                        }, {
+                        'formula': 'unit_price',
+                        }])
+            price_list.save()
+            shop = create_shop(company, price_list=price_list)
+
+            with instrument() as stats:
+                for _ in range(2):
+                    self.assertEqual(
+                        Shop.get_prices(
+                            shop, [(product.id, 1), (product.id, 5)]),
+                        {(product.id, 1): Decimal(10),
+                            (product.id, 5): Decimal(8)})
+            self.assertEqual(stats['sale.shop.get_prices']['hits'], 2)
+
+            line, _ = price_list.lines
+            line.formula = 'unit_price * 0.5'
+            line.save()
+            self.assertEqual(
+                Shop.get_prices(shop, [(product.id, 5)]),
+                {(product.id, 5): Decimal(5)})
+
+            cost_price_list = PriceList(
+                name="Cost", company=company, price='cost_price', lines=[{
+                        'formula': 'unit_price',
+                        }])
+            cost_price_list.save()
+            cost_shop = create_shop(
+                company, 'Cost', price_list=cost_price_list)
+            Product.write([product], {'cost_price': Decimal(4)})
+            self.assertEqual(
+                Shop.get_prices(cost_shop, [(product.id, 1)]),
+                {(product.id, 1): Decimal(4)})
+            Product.write([product], {'cost_price': Decimal(6)})
+            self.assertEqual(
+                Shop.get_prices(cost_shop, [(product.id, 1)]),
+                {(product.id, 1): Decimal(6)})
+
+            list_shop = create_shop(company, 'List')
+            self.assertEqual(
+                Shop.get_prices(list_shop, [(product.id, 1)]),
+                {(product.id, 1): Decimal(10)})
+
+        other_company = create_company(name="Other")
+        with set_company(other_company):
+            Template.write([template], {'list_price': Decimal(20)})
+            other_shop = create_shop(other_company)
+            self.assertEqual(
+                Shop.get_prices(other_shop, [(product.id, 1)]),
+                {(product.id, 1): Decimal(20)})
+
+    @with_transaction()
+    def test_confirm_by_shop(self):
+        "Test confirm sales by shop reports errors per shop"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Party = pool.get('party.party')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            shop1 = create_shop(company, 'Shop 1')
+            shop2 = create_shop(company, 'Shop 2')
+            party = Party(name="Customer", addresses=[{}])
+            party.save()
+            party_no_address = Party(name="Customer")
+            party_no_address.save()
+            with transaction.set_context(shops=[shop1.id, shop2.id]):
+                sale1, sale2 = Sale.create([{
+                            'shop': shop1.id,
+                            'party': party.id,
+                            'invoice_address': party.addresses[0].id,
+                            }, {
+                            'shop': shop2.id,
+                            'party': party_no_address.id,
+                            }])
+
+            @contextmanager
+            def shop_transaction(database, user, context, **extras):
+                with transaction.set_context(context):
+                    yield Mock()
+
+            with patch.object(
+                    Sale, '_shop_batch_transaction', shop_transaction):
+                results = dict(Sale.confirm_by_shop(
+                        [sale1, sale2], workers=1))
+            self.assertEqual(results[shop1.id], None)
+            self.assertTrue(results[shop2.id])
+            self.assertEqual(Sale(sale1.id).state, 'done')
+            self.assertEqual(Sale(sale2.id).state, 'draft')
+
+            executor = MagicMock()
+            executor.return_value.__enter__.return_value.map.return_value = []
+            with patch.object(sale_module, 'ThreadPoolExecutor', executor):
+                Sale.confirm_by_shop([sale1, sale2], workers=1000)
+            executor.assert_called_once_with(
+                max_workers=sale_module.BATCH_WORKERS)
+
+            set_user_shop(shop1)
+            with transaction.set_context(_check_access=True):
+                with self.assertRaises(AccessError):
+                    Sale.confirm_by_shop([sale1, sale2])
+
+    @with_transaction()
+    def test_export_shop_sales(self):
+        "Test export shop sales by batches"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Party = pool.get('party.party')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        unit, = Uom.search([('name', '=', "Unit")])
+        company = create_company()
+        with set_company(company):
+            template = Template(
+                name="Product", default_uom=unit, salable=True,
+                sale_uom=unit)
+            template.save()
+            product = Product(template=template, suffix_code='P1')
+            product.save()
+            shop = create_shop(company)
+            party = Party(name="Customer")
+            party.save()
+            with Transaction().set_context(shops=[shop.id]):
+                Sale.create([{
+                            'shop': shop.id,
+                            'party': party.id,
+                            'sale_date': sale_date,
+                            'lines': [('create', [{
+                                            'product': product.id,
+                                            'unit': unit.id,
+                                            'description': "Line",
+                                            'quantity': quantity,
+                                            'unit_price': Decimal('2.50'),
+                                            }, {
+                                            'type': 'comment',
+                                            'description': "Comment",
+                                            }])],
+                            } for sale_date, quantity in [
+                            (dt.date(2024, 1, 10), 1),
+                            (dt.date(2024, 1, 20), 2),
+                            (dt.date(2024, 2, 1), 3),
+                            ]])
+
+            with patch.object(sale_module, 'EXPORT_BATCH', 1):
+                lines = list(Sale.export_shop_sales(
+                        shop.id, dt.date(2024, 1, 1), dt.date(2024, 1, 31)))
+                rows = [json.loads(l) for l in Sale.export_shop_sales(
+                        shop.id, dt.date(2024, 1, 1), dt.date(2024, 1, 31),
+                        format='jsonl')]
+
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0], (
+                'number,sale_date,party,state,currency,'
+                'product,description,quantity,unit_price\n'))
+        self.assertEqual(lines[1], (
+                ',2024-01-10,Customer,draft,usd,P1,Line,1.0,2.50\n'))
+        self.assertEqual(
+            [(r['sale_date'], r['quantity']) for r in rows],
+            [('2024-01-10', 1.0), ('2024-01-20', 2.0)])
+
+    @with_transaction()
+    def test_migration_ledger(self):
+        "Test migrations are applied only once"
+        pool = Pool()
+        Migration = pool.get('sale.shop.migration')
+
+        self.assertEqual(
+            Migration.pending('sale.shop', ['currency', 'not_null']), set())
+        self.assertEqual(
+            Migration.pending('sale.sale', ['number_uniq']), set())
+
+        migration = Mock()
+        with patch.object(shop_module, 'MIGRATION_DRY_RUN', True):
+            Migration.apply('sale.shop', 'test', migration)
+        migration.assert_not_called()
+        self.assertEqual(Migration.pending('sale.shop', ['test']), {'test'})
+
+        for _ in range(2):
+            Migration.apply('sale.shop', 'test', migration)
+        migration.assert_called_once_with()
+        self.assertEqual(Migration.pending('sale.shop', ['test']), set())
+
+    @with_transaction()
+    def test_migration_after_dry_run(self):
+        "Test a dry run does not mark nor hide the migrations"
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Field = pool.get('ir.model.field')
+        Migration = pool.get('sale.shop.migration')
+        cursor = Transaction().connection.cursor()
+        shop_table = Shop.__table__()
+        migration_table = Migration.__table__()
+        property_ = Table('ir_property')
+
+        company = create_company()
+        with set_company(company):
+            shop = create_shop(company)
+        field, = Field.search([
+                ('model', '=', 'sale.shop'),
+                ('name', '=', 'sale_invoice_method'),
+                ])
+        cursor.execute('CREATE TABLE ir_property ('
+            'id INTEGER, field INTEGER, res VARCHAR, value VARCHAR)')
+        cursor.execute(*property_.insert(
+                [property_.field, property_.res, property_.value],
+                [[field.id, 'sale.shop,%s' % shop.id, ',shipment']]))
+
+        def reset():
+            cursor.execute(*migration_table.delete(
+                    where=migration_table.name.like('sale.shop:%')))
+
+        def invoice_method():
+            cursor.execute(*shop_table.select(
+                    shop_table.sale_invoice_method,
+                    where=shop_table.id == shop.id))
+            return cursor.fetchone()
+
+        def pending():
+            return Migration.pending(
+                'sale.shop', ['sale_invoice_method', 'logo'])
+
+        # The existing column is not filled with the old property
+        reset()
+        cursor.execute(*shop_table.update(
+                [shop_table.sale_invoice_method], [Null]))
+        Shop.__register__('sale_shop')
+        self.assertEqual(invoice_method(), (None,))
+        self.assertEqual(pending(), set())
+
+        # The new column is filled after a dry run
+        reset()
+        Shop.__table_handler__().drop_column('sale_invoice_method')
+        with patch.object(shop_module, 'MIGRATION_DRY_RUN', True):
+            Shop.__register__('sale_shop')
+        self.assertFalse(
+            Shop.__table_handler__().column_exist('sale_invoice_method'))
+        self.assertEqual(pending(), {'sale_invoice_method', 'logo'})
+
+        Shop.__register__('sale_shop')
+        self.assertEqual(invoice_method(), ('shipment',))
+        self.assertEqual(pending(), set())
+
+    @with_transaction()
+    def test_get_changes(self):
+        "Test change feed of the shop with compaction"
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Sale = pool.get('sale.sale')
+        Party = pool.get('party.party')
+        UserShop = pool.get('sale.shop-res.user')
+        Change = pool.get('sale.shop.change')
+        change_table = Change.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            shop = create_shop(company)
+            other = create_shop(company, 'Other')
+            party = Party(name="Customer")
+            party.save()
+            changes, head = Shop.get_changes(shop.id)
+            self.assertEqual(changes, None)
+
+            with Transaction().set_context(shops=[shop.id, other.id]):
+                sale1, sale2 = Sale.create([{
+                            'shop': shop.id,
+                            'party': party.id,
+                            }, {
+                            'shop': other.id,
+                            'party': party.id,
+                            }])
+                Sale.write([sale1], {'comment': "Test"})
+                user_shop, = UserShop.create([{
+                            'user': Transaction().user,
+                            'shop': shop.id,
+                            }])
+                Shop.write([shop], {'name': "Renamed"})
+                Sale.write([sale2], {'shop': shop.id})
+                Sale.delete([sale1])
+
+            # The changes are inserted at the commit or before reading them
+            cursor.execute(*change_table.select(
+                    Count(Literal('*')),
+                    where=(change_table.shop == shop.id)
+                    & (change_table.id > head)))
+            self.assertEqual(cursor.fetchone(), (0,))
+            changes, cursor_ = Shop.get_changes(shop.id, head)
+            self.assertEqual(changes, [
+                    ['sale.shop-res.user', user_shop.id, 'write'],
+                    ['sale.shop', shop.id, 'write'],
+                    ['sale.sale', sale2.id, 'write'],
+                    ['sale.sale', sale1.id, 'delete'],
+                    ])
+            self.assertEqual(
+                Shop.get_changes(shop.id, cursor_), ([], cursor_))
+            self.assertIn(
+                ['sale.sale', sale2.id, 'delete'],
+                Shop.get_changes(other.id, 0)[0])
+
+            changes, _ = Shop.get_changes(shop.id, head, limit=1)
+            self.assertEqual(len(changes), 1)
+
+            Change.compact()
+            cursor.execute(*change_table.select(
+                    Count(Literal('*')),
+                    where=(change_table.shop == shop.id)
+                    & (change_table.model == 'sale.sale')
+                    & (change_table.record == sale1.id)))
+            self.assertEqual(cursor.fetchone(), (1,))
+            self.assertEqual(len(Shop.get_changes(shop.id, head)[0]), 4)
+
+            cursor.execute(*change_table.update(
+                    [change_table.create_date],
+                    [dt.datetime(2000, 1, 1)],
+                    where=change_table.id <= cursor_))
+            Change.compact()
+            self.assertEqual(Shop.get_changes(shop.id, head)[0], None)
+            changes, cursor_ = Shop.get_changes(shop.id)
+            self.assertEqual(Shop.get_changes(shop.id, cursor_)[0], [])
+
+            with Transaction().set_context(_check_access=True):
+                with self.assertRaises(AccessError):
+                    Shop.get_changes(other.id, cursor_)
+                set_user_shop(other)
+                self.assertTrue(Shop.get_changes(other.id, cursor_)[0])
+
+    @with_transaction()
+    def test_shop_rule_join(self):
+        "Test shop rule filtering the user shops in SQL"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Rule = pool.get('ir.rule')
+        User = pool.get('res.user')
+        Group = pool.get('res.group')
+        ModelData = pool.get('ir.model.data')
+        Party = pool.get('party.party')
+        transaction = Transaction()
+
+        group = Group(ModelData.get_id('sale', 'group_sale'))
+        company = create_company()
+        with set_company(company):
+            shop1 = create_shop(company, 'Shop 1')
+            shop2 = create_shop(company, 'Shop 2')
+            users = User.create([{
+                        'name': name,
+                        'login': name,
+                        'groups': [('add', [group.id])],
+                        'companies': [('add', [company.id])],
+                        'company': company.id,
+                        'shops': [('add', [s.id for s in shops])],
+                        } for name, shops in [
+                        ('user1', [shop1]), ('user2', [shop1, shop2])]])
+            party = Party(name="Customer")
+            party.save()
+            with transaction.set_context(shops=[shop1.id, shop2.id]):
+                sale1, sale2 = Sale.create([
+                        {'party': party.id, 'shop': shop1.id},
+                        {'party': party.id, 'shop': shop2.id},
+                        ])
+
+        with patch.object(ir, 'SHOP_RULE_MODE', 'join'):
+            domains = []
+            for user, sales in zip(users, [[sale1], [sale1, sale2]]):
+                with transaction.set_user(user.id), \
+                        transaction.set_context(
+                            company=company.id, _check_access=True):
+                    Rule._domain_get_cache.clear()
+                    domains.append(Rule.domain_get('sale.sale'))
+                    self.assertEqual(
+                        Sale.search([], order=[('id', 'ASC')]), sales)
+            self.assertEqual(*domains)
+            self.assertIn(
+                [['shop.current_user_shop', '=', True]], domains[0][-1])
+
+    @with_transaction()
+    def test_shop_rule_inactive(self):
+        "Test shop rule excludes the inactive shops in both modes"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Shop = pool.get('sale.shop')
+        Rule = pool.get('ir.rule')
+        User = pool.get('res.user')
+        Group = pool.get('res.group')
+        ModelData = pool.get('ir.model.data')
+        Party = pool.get('party.party')
+        transaction = Transaction()
+
+        group = Group(ModelData.get_id('sale', 'group_sale'))
+        company = create_company()
+        with set_company(company):
+            shop1 = create_shop(company, 'Shop 1')
+            shop2 = create_shop(company, 'Shop 2')
+            user, = User.create([{
+                        'name': 'user',
+                        'login': 'user',
+                        'groups': [('add', [group.id])],
+                        'companies': [('add', [company.id])],
+                        'company': company.id,
+                        'shops': [('add', [shop1.id, shop2.id])],
+                        }])
+            party = Party(name="Customer")
+            party.save()
+            with transaction.set_context(shops=[shop1.id, shop2.id]):
+                sale1, _ = Sale.create([
+                        {'party': party.id, 'shop': shop1.id},
+                        {'party': party.id, 'shop': shop2.id},
+                        ])
+            Shop.write([shop2], {'active': False})
+
+        for mode in ['list', 'join']:
+            with self.subTest(mode=mode), \
+                    patch.object(ir, 'SHOP_RULE_MODE', mode), \
+                    transaction.set_user(user.id), \
+                    transaction.set_context(
+                        company=company.id, _check_access=True):
+                Rule._domain_get_cache.clear()
+                self.assertEqual(User.get_shops(), (shop1.id,))
+                self.assertEqual(Sale.search([]), [sale1])
+
+    @with_transaction()
+    def test_shop_logo(self):
+        "Test shop logo is stored in the filestore"
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        cursor = Transaction().connection.cursor()
+        shop_table = Shop.__table__()
+
+        company = create_company()
+        with set_company(company):
+            shop = create_shop(company)
+        cursor.execute(*shop_table.update(
+                [shop_table.logo], [b'inline'],
+                where=shop_table.id == shop.id))
+
+        Shop._migrate_logo()
+
+        cursor.execute(*shop_table.select(
+                shop_table.logo, shop_table.logo_size,
+                where=shop_table.id == shop.id))
+        self.assertEqual(cursor.fetchone(), (None, len(b'inline')))
+        shop = Shop(shop.id)
+        self.assertTrue(shop.logo_id)
+        self.assertEqual(shop.logo, b'inline')
+        self.assertTrue(shop.logo_thumbnail)
+
+    @unittest.skipIf(backend.name != 'sqlite', 'SQLite query plan')
+    @with_transaction()
+    def test_shop_indexes(self):
+        "Test shop access paths use indexes"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Shop = pool.get('sale.shop')
+        UserShop = pool.get('sale.shop-res.user')
+        cursor = Transaction().connection.cursor()
+        sale = Sale.__table__()
+        shop = Shop.__table__()
+        user_shop = UserShop.__table__()
+
+        for query in [
+                sale.select(sale.id, where=(sale.shop == 1)
+                    & (sale.state == 'draft') & (sale.sale_date > '2020-01-01')),
+                shop.select(shop.id, where=shop.warehouse == 1),
+                shop.select(shop.id, where=shop.company == 1),
+                user_shop.select(user_shop.shop, where=user_shop.user == 1),
+                ]:
+            with self.subTest(query=str(query)):
+                query, params = tuple(query)
+                cursor.execute('EXPLAIN QUERY PLAN ' + query, params)
+                plan = ' '.join(str(r[-1]) for r in cursor)
+                self.assertIn('INDEX', plan)
+                self.assertNotRegex(plan, r'SCAN \S+$')
+
+    @with_transaction()
+    def test_daily_summary(self):
+        "Test shop daily summary"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Shop = pool.get('sale.shop')
+        Summary = pool.get('sale.shop.daily_summary')
+        Party = pool.get('party.party')
+        Date = pool.get('ir.date')
+
+        def summaries():
+            return sorted(
+                (s.shop.id, s.date, s.state, s.currency.id, s.sales)
+                for s in Summary.search([]))
+
+        company = create_company()
+        with set_company(company):
+            shop = create_shop(company)
+            set_user_shop(shop)
+            party = Party(name="Customer")
+            party.save()
+
+        date = dt.date(2024, 1, 10)
+        with set_company(company), \
+                Transaction().set_context(shops=[shop.id]):
+            sales = Sale.create(
+                [{'party': party.id, 'sale_date': date}] * 3
+                + [{'party': party.id}])
+            self.assertEqual(Shop(shop.id).draft_sales, 4)
+            # The sales without date are summarized at their creation
+            created = sales[-1].create_date.date()
+
+            Sale.write(sales[:1], {'state': 'cancelled'})
+            Sale.delete(sales[1:2])
+            self.assertEqual(Shop(shop.id).draft_sales, 2)
+            self.assertEqual(summaries(), sorted([
+                        (shop.id, date, 'cancelled', company.currency.id, 1),
+                        (shop.id, date, 'draft', company.currency.id, 1),
+                        (shop.id, created, 'draft', company.currency.id, 1),
+                        ]))
+
+            Sale.write(sales[:1], {'state': 'draft'})
+            self.assertEqual(summaries(), sorted([
+                        (shop.id, date, 'draft', company.currency.id, 2),
+                        (shop.id, created, 'draft', company.currency.id, 1),
+                        ]))
+
+            incremental = summaries()
+            Shop.rebuild_daily_summary([shop])
+            self.assertEqual(summaries(), incremental)
+
+            other = create_shop(company, 'Other')
+            self.assertEqual(Shop(shop.id).today_amount, None)
+            Summary.update({
+                    (shop.id, Date.today(), 'confirmed',
+                        company.currency.id): [1, Decimal(10), Decimal(12)],
+                    })
+            with instrument() as stats:
+                shops = Shop.browse([shop.id, other.id])
+                self.assertEqual(
+                    [(s.today_amount, s.draft_sales) for s in shops],
+                    [(Decimal(12), 3), (None, 0)])
+            self.assertEqual(stats.queries('sale.shop.get_daily_summary'), 1)
+
+    @with_transaction()
+    def test_benchmark(self):
+        "Test benchmark runs"
+        from . import benchmark
+
+        result = benchmark.run(shops=2, users=1, sales=2, iterations=2)
+
+        self.assertEqual(set(result['results']), {
+                'sale.default_get',
+                'sale.on_change_shop',
+                'sale.set_number',
+                'ir.rule.domain_get',
+                'stock.shipment.out.shop_addresses',
+                })
+
+    @with_transaction()
+    def test_instrument(self):
+        "Test instrumentation of shop defaults"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Shop = pool.get('sale.shop')
+
+        company = create_company()
+        with set_company(company):
+            shop = create_shop(company)
+            set_user_shop(shop)
+            # Fill the sale settings cache shared between transactions
+            Shop.get_sale_settings([shop.id])
+            Sale.clear_current_shop_cache()
+
+            with instrument() as stats:
+                Sale.default_get(['shop', 'warehouse', 'company'])
+                Sale.default_get(['shop', 'warehouse', 'company'])
+
+        defaults = stats['sale.sale.current_shop_defaults']
+        self.assertEqual(defaults['misses'], 1)
+        self.assertGreaterEqual(defaults['hits'], 5)
+        self.assertEqual(stats['res.user.get_shop_context']['calls'], 1)
+        self.assertEqual(stats['sale.shop.get_sale_settings']['hits'], 1)
+        self.assertLessEqual(
+            stats.queries('sale.sale.current_shop_defaults'), 4)
+
+
+    @with_transaction()
+    def test_query_counter_nested(self):
+        "Test nested query counters on the same connection"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        outer = QueryCounter(transaction.connection)
+        inner = QueryCounter(transaction.connection)
+        with outer():
+            cursor.execute('SELECT 1')
+            with inner():
+                cursor.execute('SELECT 1')
+            cursor.execute('SELECT 1')
+        cursor.execute('SELECT 1')
+
+        self.assertEqual((outer.count, inner.count), (3, 1))
+
+    @with_transaction()
+    def test_query_counter_threads(self):
+        "Test the query counters of PostgreSQL count only their thread"
+        connection = Transaction().connection
+        db_logger = logging.getLogger('trytond.backend.postgresql.database')
+
+        def log():
+            db_logger.debug("SELECT 1")
+
+        with patch.object(backend, 'name', 'postgresql'):
+            counters = [QueryCounter(connection) for _ in range(2)]
+            other = QueryCounter(connection)
+            other._thread = None
+            with counters[0](), counters[1](), other():
+                log()
+                thread = threading.Thread(target=log)
+                thread.start()
+                thread.join()
+            log()
+            self.assertFalse(QueryCounter._pg_counters)
+
+        self.assertEqual([c.count for c in counters], [1, 1])
+        self.assertEqual(other.count, 0)
+
 
 del ModuleTestCase
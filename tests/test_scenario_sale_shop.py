@@ -1,3 +1,4 @@
+import base64
 import unittest
 from decimal import Decimal
 
@@ -8,9 +9,12 @@ from trytond.modules.account.tests.tools import (create_chart,
 from trytond.modules.account_invoice.tests.tools import (
     create_payment_term, set_fiscalyear_invoice_sequences)
 from trytond.modules.company.tests.tools import create_company, get_company
+from trytond import backend
 from trytond.modules.sale_shop.tests.tools import create_shop
-from trytond.tests.test_tryton import drop_db
+from trytond.protocols.wrappers import Response
+from trytond.tests.test_tryton import Client, drop_db
 from trytond.tests.tools import activate_modules, set_user
+from trytond.wsgi import app
 
 
 class Test(unittest.TestCase):
@@ -144,3 +148,61 @@ class Test(unittest.TestCase):
         sale_line.quantity = 3.0
         sale.save()
         self.assertEqual(sale.state, 'draft')
+
+        # Confirm the sales of the shops in one transaction per shop
+        shop2 = create_shop(payment_term, price_list, name='Shop 2')
+        shop2.save()
+        user.shops.append(shop2)
+        user.save()
+        set_user(user)
+        no_address = Party(name='No Address')
+        while no_address.addresses:
+            no_address.addresses.pop()
+        no_address.save()
+        shop2_sales = []
+        for party in [customer, no_address]:
+            shop2_sale = Sale(shop=shop2)
+            shop2_sale.party = party
+            shop2_sale_line = shop2_sale.lines.new()
+            shop2_sale_line.product = product
+            shop2_sale_line.quantity = 1.0
+            shop2_sale.save()
+            shop2_sales.append(shop2_sale)
+        # SQLite memory databases can not be shared between threads
+        workers = 1 if backend.name == 'sqlite' else 2
+        results = dict(Sale.confirm_by_shop(
+                [sale.id] + [s.id for s in shop2_sales], workers,
+                config.context))
+        self.assertEqual(results[shop.id], None)
+        self.assertTrue(results[shop2.id])
+        sale.reload()
+        self.assertEqual(sale.state, 'processing')
+        self.assertTrue(sale.number)
+        for shop2_sale in shop2_sales:
+            shop2_sale.reload()
+            self.assertEqual(shop2_sale.state, 'draft')
+            self.assertFalse(shop2_sale.number)
+
+        # Export the sales of the shop
+        user.password = 'S3cret-Passw0rd'
+        user.save()
+        client = Client(app, Response)
+        headers = {
+            'Authorization': 'Basic ' + base64.b64encode(
+                ('%s:S3cret-Passw0rd' % user.login).encode()).decode(),
+            }
+        url = '/%s/sale_shop/%%s/sales.csv' % config.database_name
+        dates = {
+            'start': sale.sale_date.isoformat(),
+            'end': sale.sale_date.isoformat(),
+            }
+        response = client.get(
+            url % shop.id, headers=headers, query_string=dates)
+        self.assertEqual(response.status_code, 200)
+        lines = response.data.decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith(sale.number + ','))
+        response = client.get(url % 0, headers=headers, query_string=dates)
+        self.assertEqual(response.status_code, 403)
+        response = client.get(url % shop.id, headers=headers)
+        self.assertEqual(response.status_code, 400)
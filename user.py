@@ -1,19 +1,38 @@
 # This file is part sale_shop module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.model import fields
+from sql import Literal
+
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import ModelSQL, Unique, fields
 from trytond.pyson import Eval
-from trytond.pool import PoolMeta
-from trytond.transaction import Transaction
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction, without_check_access
+
+from .instrument import hit, instrumented, miss
+
+PREFERENCES_SHOP_CATALOG = config.getboolean(
+    'sale_shop', 'preferences_shop_catalog', default=False)
 
 
 class User(metaclass=PoolMeta):
     __name__ = "res.user"
     shops = fields.Many2Many('sale.shop-res.user', 'user', 'shop', 'Shops')
+    shop_groups = fields.Many2Many(
+        'sale.shop.group-res.user', 'user', 'group', "Shop Groups",
+        help="The user can access the shops of the groups and their "
+        "children.")
     shop = fields.Many2One('sale.shop', 'Shop', domain=[
-            ('id', 'in', Eval('shops', [])),
+            ['OR',
+                ('id', 'in', Eval('shops', [])),
+                ('group', 'child_of', Eval('shop_groups', []), 'parent'),
+                ],
             ('company', '=', Eval('company', -1),)
             ])
+    _get_shops_cache = Cache(__name__ + '.get_shops', context=False)
+    _shop_catalog_cache = Cache(
+        __name__ + '.get_shop_catalog', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -21,54 +40,196 @@ class User(metaclass=PoolMeta):
         cls._context_fields.insert(0, 'shop')
         cls._context_fields.insert(0, 'shops')
 
+    @classmethod
+    def on_modification(cls, mode, users, field_names=None):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        super().on_modification(mode, users, field_names=field_names)
+        if mode == 'write' and (field_names is None
+                or {'shop', 'shops', 'shop_groups'} & set(field_names)):
+            Sale.clear_current_shop_cache()
+            cls._get_shops_cache.clear()
+            cls._shop_catalog_cache.clear()
+        if mode in {'create', 'write'} and (field_names is None
+                or {'company', 'shop'} & set(field_names)):
+            cls._remember_shop(users)
+
     def get_status_bar(self, name):
+        pool = Pool()
+        Shop = pool.get('sale.shop')
         status = super(User, self).get_status_bar(name)
-        if self.shop:
-            status += ' - %s' % (self.shop.rec_name)
+        shop, _ = self._get_shop_context(self.id)
+        if shop is not None:
+            names = {s: n for s, n, _ in self._get_shop_catalog(self.id)}
+            status += ' - %s' % (names.get(shop) or Shop(shop).rec_name)
         return status
 
-    @fields.depends('shops')
+    @fields.depends('shops', 'shop_groups')
     def on_change_company(self):
+        pool = Pool()
+        Shop = pool.get('sale.shop')
         super().on_change_company()
         self.shop = None
 
         if self.company:
-            shops = [shop for shop in self.shops
-                        if shop.company == self.company]
+            domain = ['OR',
+                ('id', 'in', [s.id for s in self.shops if s.id is not None]),
+                ('group', 'child_of',
+                    [g.id for g in self.shop_groups if g.id is not None],
+                    'parent'),
+                ]
+            shop = self._last_shop(self.company)
+            if shop is not None and Shop.search(
+                    [('id', '=', shop), domain], limit=1):
+                self.shop = shop
+                return
+            shops = Shop.search([
+                    domain,
+                    ('company', '=', self.company.id),
+                    ], limit=2)
             if len(shops) == 1:
-                self.shop = shops[0]
+                self.shop, = shops
+
+    def _last_shop(self, company):
+        "Return the id of the last shop used by the user for the company"
+        pool = Pool()
+        CompanyShop = pool.get('res.user.company_shop')
+        if self.id is None or self.id < 0:
+            return
+        with without_check_access():
+            company_shops = CompanyShop.search([
+                    ('user', '=', self.id),
+                    ('company', '=', company.id),
+                    ], limit=1)
+        if company_shops:
+            company_shop, = company_shops
+            return company_shop.shop.id
+
+    @classmethod
+    def _remember_shop(cls, users):
+        "Store the current shop of the users as the last one of the company"
+        pool = Pool()
+        CompanyShop = pool.get('res.user.company_shop')
+        users = [u for u in cls.browse(users) if u.company and u.shop]
+        if not users:
+            return
+        company_shops = {
+            (c.user, c.company): c for c in CompanyShop.search([
+                    ('user', 'in', [u.id for u in users]),
+                    ])}
+        to_save = []
+        for user in users:
+            company_shop = company_shops.get((user, user.company))
+            if company_shop is None:
+                company_shop = CompanyShop(user=user, company=user.company)
+            elif company_shop.shop == user.shop:
+                continue
+            company_shop.shop = user.shop
+            to_save.append(company_shop)
+        CompanyShop.save(to_save)
 
     @classmethod
     def _get_preferences(cls, user, context_only=False):
+        shop, shops = cls._get_shop_context(user.id)
+        # Use the cached shops instead of reading the relation
+        user = cls(user.id, shop=shop, shops=shops)
         res = super(User, cls)._get_preferences(user,
             context_only=context_only)
         if not context_only:
-            res['shops'] = [c.id for c in user.shops]
-            res['shop'] = user.shop and user.shop.id or None
+            res['shops'] = list(shops)
+            res['shop'] = shop
+            if PREFERENCES_SHOP_CATALOG:
+                res['shops.catalog'] = [
+                    list(s) for s in cls._get_shop_catalog(user.id)]
         return res
 
     @classmethod
-    def get_shop(cls):
+    @instrumented('res.user.get_shop_context')
+    def _get_shop_context(cls, user_id=None):
         '''
-        Return an shop id for the user
+        Return the shop id and the ordered tuple of shop ids for the user
         '''
+        pool = Pool()
+        Shop = pool.get('sale.shop')
         transaction = Transaction()
-        user_id = transaction.user
+        if user_id is None:
+            user_id = transaction.user
+        result = cls._get_shops_cache.get(user_id)
+        if result is not None:
+            hit('res.user.get_shop_context')
+            return result
+        miss('res.user.get_shop_context')
 
-        with transaction.set_user(0):
-            user = cls(user_id)
-        return user.shop and user.shop.id or None
+        cursor = transaction.connection.cursor()
+        user = cls.__table__()
+        shop = Shop.__table__()
+        cursor.execute(*user.select(user.shop, where=user.id == user_id))
+        row = cursor.fetchone()
+        cursor.execute(*shop.select(shop.id,
+                where=shop.id.in_(Shop._user_shops_query(user_id))
+                & (shop.active == Literal(True)),
+                order_by=[shop.name.asc, shop.id.asc]))
+        result = (row[0] if row else None, tuple(s for s, in cursor))
+        cls._get_shops_cache.set(user_id, result)
+        return result
 
     @classmethod
-    def get_shops(cls):
+    def _get_shop_catalog(cls, user_id=None):
         '''
-        Return an ordered tuple of shop ids for the user
+        Return the ordered tuple of id, name and company of the user shops
         '''
+        pool = Pool()
+        Shop = pool.get('sale.shop')
         transaction = Transaction()
-        user_id = transaction.user
+        if user_id is None:
+            user_id = transaction.user
+        catalog = cls._shop_catalog_cache.get(user_id)
+        if catalog is not None:
+            return catalog
+
+        cursor = transaction.connection.cursor()
+        shop = Shop.__table__()
+        cursor.execute(*shop.select(shop.id, shop.name, shop.company,
+                where=shop.id.in_(Shop._user_shops_query(user_id))
+                & (shop.active == Literal(True)),
+                order_by=[shop.name.asc, shop.id.asc]))
+        catalog = tuple(tuple(r) for r in cursor)
+        cls._shop_catalog_cache.set(user_id, catalog)
+        return catalog
+
+    @classmethod
+    def get_shop(cls):
+        '''
+        Return an shop id for the user
+        '''
+        shop, _ = cls._get_shop_context()
+        return shop
 
-        with transaction.set_user(0):
-            user = cls(user_id)
-        shops = [c.id for c in user.shops]
-        shops = tuple(shops)
+    @classmethod
+    def get_shops(cls):
+        '''
+        Return an ordered tuple of shop ids for the user
+        '''
+        _, shops = cls._get_shop_context()
         return shops
+
+
+class UserCompanyShop(ModelSQL):
+    'User Company Shop'
+    __name__ = 'res.user.company_shop'
+
+    user = fields.Many2One(
+        'res.user', "User", required=True, ondelete='CASCADE')
+    company = fields.Many2One(
+        'company.company', "Company", required=True, ondelete='CASCADE')
+    shop = fields.Many2One(
+        'sale.shop', "Shop", required=True, ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('user_company_unique', Unique(t, t.user, t.company),
+                'sale_shop.msg_user_company_shop_unique'),
+            ]